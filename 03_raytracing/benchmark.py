@@ -0,0 +1,184 @@
+"""
+Benchmark suite for raytracer.py
+
+Renders the built-in scene and scaled-up variants of it for every
+combination of resolution, object count, bounce depth and dtype, and
+reports rays per second, wall time and peak resident memory as JSON.
+Every case runs in a fresh interpreter so that its peak RSS is its own.
+Cases in a reduced precision are also compared to the float64 image of the
+same case, which always runs first: the fraction of pixels off by more than
+2 of 255 levels.
+
+    python benchmark.py                         # print the results
+    python benchmark.py --save                  # store them as the baseline
+    python benchmark.py --check --threshold .1  # exit 1 on regressions > 10%
+    python benchmark.py --dtypes float64 float32 --max-pixels-off .001
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import resource
+import tempfile
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DTYPES = ("float64", "float32")
+
+
+def scaled_scene(rt, objects, seed = 0):
+    # the built-in scene plus random spheres behind it, up to objects primitives
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    scene = list(rt.scene)
+    for _ in range(objects - len(scene)):
+        c = rng.uniform((-3, -.8, 3), (3, 2.5, 8))
+        scene.append(rt.Sphere(rt.vec3(*c), rng.uniform(.1, .3), rt.vec3(*rng.uniform(0, 1, 3)),
+                               mirror=rng.uniform(0, .5)))
+    return scene
+
+
+def run_case(case):
+    # renders one case in this process and returns its measurements
+    import numpy as np
+    import raytracer as rt
+
+    class CountingBVH(rt.BVH):
+        # counts the rays cast into the scene: camera, reflected and shadow rays
+        rays = 0
+
+        def intersect(self, O, D):
+            self.rays += len(D.v) if D.v.ndim == 2 else 1
+            return super().intersect(O, D)
+
+        def occluded(self, O, D, maxdist, exclude = -1):
+            self.rays += len(D.v) if D.v.ndim == 2 else 1
+            return super().occluded(O, D, maxdist, exclude)
+
+    rt.set_precision(case["dtype"])
+    rt.integrator = rt.Integrator(max_depth=case["bounces"])
+    (width, height) = case["resolution"]
+    frame = (0, 0, width, height)
+    objects = scaled_scene(rt, case["objects"])
+
+    rt.trace_tile(width, height, frame, rt.BVH(objects))   # warm up caches
+    times = []
+    for _ in range(case["repeat"]):
+        world = CountingBVH(objects)
+        t0 = time.perf_counter()
+        color = rt.trace_tile(width, height, frame, world)
+        times.append(time.perf_counter() - t0)
+    seconds = min(times)
+    if "image" in case:
+        np.save(case["image"], (255 * np.clip(color, 0, 1)).astype(np.uint8))
+    return {"seconds": seconds,
+            "rays": world.rays,
+            "rays_per_second": world.rays / seconds,
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def case_name(case):
+    (width, height) = case["resolution"]
+    return "%dx%d-%dobj-%db-%s" % (width, height, case["objects"], case["bounces"], case["dtype"])
+
+
+def cases(args):
+    # float64 always runs, right before the reduced precision cases of the same
+    # scene, which are compared to its image
+    dtypes = [d for d in DTYPES if d in args.dtypes or d == "float64"]
+    return [{"resolution": r, "objects": n, "bounces": b, "dtype": d, "repeat": args.repeat}
+            for r in args.resolutions for n in args.objects for b in args.bounces for d in dtypes]
+
+
+def measure(case):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+                         check=True, stdout=subprocess.PIPE, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def image_diff(image, reference):
+    # largest difference and fraction of pixels off by more than 2 levels
+    import numpy as np
+    d = np.abs(np.load(image).astype(int) - np.load(reference)).max(axis=-1)
+    return {"image_max_diff": int(d.max()), "image_pixels_off": float((d > 2).mean())}
+
+
+def regressions(results, baseline, threshold):
+    # cases that got slower, or use more memory, by more than threshold
+    failed = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["rays_per_second"] < base["rays_per_second"] * (1 - threshold):
+            failed.append((name, "rays_per_second", base["rays_per_second"], result["rays_per_second"]))
+        if result["seconds"] > base["seconds"] * (1 + threshold):
+            failed.append((name, "seconds", base["seconds"], result["seconds"]))
+        if result["peak_rss_mib"] > base["peak_rss_mib"] * (1 + threshold):
+            failed.append((name, "peak_rss_mib", base["peak_rss_mib"], result["peak_rss_mib"]))
+    return failed
+
+
+def resolution(text):
+    (width, height) = text.lower().split("x")
+    return (int(width), int(height))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resolutions", type=resolution, nargs="+", default=[(160, 120), (320, 240), (640, 480)])
+    parser.add_argument("--objects", type=int, nargs="+", default=[5, 50, 200])
+    parser.add_argument("--bounces", type=int, nargs="+", default=[2])
+    parser.add_argument("--dtypes", nargs="+", default=list(DTYPES), choices=DTYPES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--check", action="store_true", help="exit 1 if a case regressed against the baseline")
+    parser.add_argument("--threshold", type=float, default=.1, help="allowed relative regression")
+    parser.add_argument("--max-pixels-off", type=float, default=.001,
+                        help="allowed fraction of pixels that differ from the float64 image")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    if args.check and not args.save and not os.path.exists(args.baseline):
+        print("no baseline %s to check against, run with --save first" % args.baseline, file=sys.stderr)
+        return 2
+
+    results = {}
+    with tempfile.TemporaryDirectory() as images:
+        for case in cases(args):
+            name = case_name(case)
+            case["image"] = os.path.join(images, name + ".npy")
+            results[name] = measure(case)
+            reference = os.path.join(images, case_name(dict(case, dtype="float64")) + ".npy")
+            if case["dtype"] != "float64":
+                results[name].update(image_diff(case["image"], reference))
+            print(name, json.dumps(results[name]), file=sys.stderr)
+    print(json.dumps(results, indent=2))
+    failed = False
+    for (name, result) in results.items():
+        if result.get("image_pixels_off", 0) > args.max_pixels_off:
+            print("IMAGE DIFF %s: %.4g of the pixels differ" % (name, result["image_pixels_off"]), file=sys.stderr)
+            failed = True
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.check:
+        with open(args.baseline) as file:
+            regressed = regressions(results, json.load(file), args.threshold)
+        for (name, metric, base, value) in regressed:
+            print("REGRESSION %s %s: %.4g -> %.4g" % (name, metric, base, value), file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,73 +1,619 @@
-from PIL import Image
-from functools import reduce
 import numpy as np
 import time
-import numbers
+import os
+import atexit
+import pickle
+import hashlib
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 
-def extract(cond, x):
-    if isinstance(x, numbers.Number):
-        return x
+def operand(x):
+    # per ray scalars broadcast against the last axis of a vec3 buffer
+    if isinstance(x, vec3):
+        return x.v
+    elif isinstance(x, np.ndarray):
+        return x[..., np.newaxis]
     else:
-        return np.extract(cond, x)
+        return x
+
+def as_vec3(v):
+    # wraps an existing (..., 3) buffer without copying it
+    r = vec3.__new__(vec3)
+    r.v = v
+    return r
 
 class vec3():
+    # x, y and z share one contiguous (..., 3) float buffer. A single vector
+    # is a (3,) buffer that broadcasts against (n, 3) ray batches. All
+    # arithmetic takes an optional out vec3, the in-place operators reuse
+    # the left buffer whenever the result has the same shape.
     def __init__(self, x, y, z):
-        (self.x, self.y, self.z) = (x, y, z)
+        self.v = np.stack(np.broadcast_arrays(x, y, z), axis=-1).astype(DTYPE, copy=False)
+    @property
+    def x(self):
+        return self.v[..., 0]
+    @property
+    def y(self):
+        return self.v[..., 1]
+    @property
+    def z(self):
+        return self.v[..., 2]
+    def result(self, r, out):
+        return as_vec3(r) if out is None else out
+    def fits(self, other):
+        return np.broadcast_shapes(self.v.shape, np.shape(operand(other))) == self.v.shape
+    def mul(self, other, out = None):
+        return self.result(np.multiply(self.v, operand(other), out=None if out is None else out.v), out)
+    def add(self, other, out = None):
+        return self.result(np.add(self.v, operand(other), out=None if out is None else out.v), out)
+    def sub(self, other, out = None):
+        return self.result(np.subtract(self.v, operand(other), out=None if out is None else out.v), out)
     def __mul__(self, other):
-        return vec3(self.x * other, self.y * other, self.z * other)
+        return self.mul(other)
     def __add__(self, other):
-        return vec3(self.x + other.x, self.y + other.y, self.z + other.z)
+        return self.add(other)
     def __sub__(self, other):
-        return vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+        return self.sub(other)
+    def __imul__(self, other):
+        return self.mul(other, out=self if self.fits(other) else None)
+    def __iadd__(self, other):
+        return self.add(other, out=self if self.fits(other) else None)
+    def __isub__(self, other):
+        return self.sub(other, out=self if self.fits(other) else None)
     def dot(self, other):
-        return (self.x * other.x) + (self.y * other.y) + (self.z * other.z)
+        if other.v.ndim == 1:
+            return self.v @ other.v
+        elif self.v.ndim == 1:
+            return other.v @ self.v
+        return np.einsum('...i,...i->...', self.v, other.v)
     def __abs__(self):
         return self.dot(self)
-    def norm(self):
+    def norm(self, out = None):
         mag = np.sqrt(abs(self))
-        return self * (1.0 / np.where(mag == 0, 1, mag))
+        return self.mul(1.0 / np.where(mag == 0, 1, mag), out=out)
+    def normalize(self):
+        return self.norm(out=self)
     def components(self):
         return (self.x, self.y, self.z)
+    def array(self):
+        return np.array(self.v)
     def extract(self, cond):
-        return vec3(extract(cond, self.x),
-                    extract(cond, self.y),
-                    extract(cond, self.z))
-    def place(self, cond):
-        r = vec3(np.zeros(cond.shape), np.zeros(cond.shape), np.zeros(cond.shape))
-        np.place(r.x, cond, self.x)
-        np.place(r.y, cond, self.y)
-        np.place(r.z, cond, self.z)
-        return r
-    def cross(self, other):
-        a = ((self.y * other.z) - (self.z * other.y))
-        b = ((self.z * other.x) - (self.x * other.z))
-        c = ((self.x * other.y) - (self.y * other.x))
-        return vec3(a, b, c)
+        return self if self.v.ndim == 1 else as_vec3(self.v[cond])
+    def take(self, idx):
+        return self if self.v.ndim == 1 else as_vec3(np.take(self.v, idx, axis=0))
+    def cross(self, other, out = None):
+        (a, b) = np.broadcast_arrays(self.v, other.v)
+        r = np.empty(a.shape, dtype=np.result_type(a, b)) if out is None else out.v
+        for (i, j, k) in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+            np.multiply(a[..., j], b[..., k], out=r[..., i])
+            r[..., i] -= a[..., k] * b[..., j]
+        return self.result(r, out)
 rgb = vec3
 
-L = vec3(5, 5, -10)         # Point light position
+DTYPE = np.float64          # float type of the pipeline, see set_precision
+
 E = vec3(0, 0.35, -1)       # Eye position
-FARAWAY = 1.0e39            # an implausibly huge distance
+FARAWAY = 1.0e30            # an implausibly huge distance, finite in float32
+
+class PointLight:
+    # A point light of the given color. With a range its light falls off
+    # smoothly, as (1 - (d / range)^2)^2, to nothing at that distance,
+    # without one it does not fall off at all.
+    def __init__(self, position, color = (1, 1, 1), range = None):
+        self.position = position
+        self.color = rgb(*color)
+        self.range = range
+
+    def falloff(self, d):
+        # attenuation at the distances d, None for a light without range
+        if self.range is None:
+            return None
+        f = d / self.range
+        f *= f
+        np.subtract(1, f, out=f)
+        np.maximum(f, 0, out=f)
+        f *= f
+        return f
+
+    def astype(self, dtype):
+        self.position = as_vec3(self.position.v.astype(dtype))
+        self.color = as_vec3(self.color.v.astype(dtype))
+
+lights = [PointLight(vec3(5, 5, -10))]
+LIGHT_CUTOFF = 1 / 512      # lights contributing less at a point (half an 8 bit level) cast no shadow ray
+
+class Integrator:
+    # How far reflected rays are followed: at most max_depth bounces after
+    # the camera ray, and rays whose throughput (the fraction of their color
+    # that reaches the pixel) falls below threshold are dropped. With
+    # roulette they survive with probability throughput / threshold instead
+    # and carry the threshold as throughput, which keeps the image unbiased.
+    def __init__(self, max_depth = 2, threshold = 0., roulette = False, seed = None):
+        self.max_depth = max_depth
+        self.threshold = threshold
+        self.roulette = roulette
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+    def __getstate__(self):
+        # pool processes draw their own random numbers
+        state = dict(self.__dict__)
+        del state["rng"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = np.random.default_rng(self.seed)
+
+    def survivors(self, weight, n):
+        # which of n rays with throughput weight (scalar or per ray) to trace
+        # further: None for all of them, else their indices, and their weight
+        if self.threshold <= 0:
+            return None, weight
+        weight = np.broadcast_to(weight, (n,))
+        low = weight < self.threshold
+        if not low.any():
+            return None, weight
+        alive = ~low
+        if self.roulette:
+            alive |= self.rng.random(n) * self.threshold < weight
+            weight = np.where(low, self.threshold, weight)
+        keep = np.flatnonzero(alive)
+        return keep, weight[keep]
+
+integrator = Integrator()
+
+def nudge(M):
+    # how far secondary rays start off the surface at the points M: fixed in
+    # float64, in float32 also at least 64 ulps of the largest coordinate,
+    # so that far hits (on the plane) do not intersect themselves
+    if DTYPE == np.float64:
+        return .0001
+    offset = np.abs(M.v).max(axis=-1)
+    offset *= 64 * np.finfo(DTYPE).eps
+    return np.maximum(offset, .0001, out=offset)
 
-def raytrace(O, D, scene, bounce = 0):
+STAGES = ("frame", "bvh", "rays", "convert", "intersect", "shade", "shadow", "reflect")
+
+class Stats:
+    # Opt-in instrumentation, see enable_stats: seconds, rays and hits per
+    # stage and bounce level (None for the stages of the whole frame). The
+    # frame stage includes all others, the others exclude each other. With
+    # a process pool only the frame stages of the main process are counted.
+    def __init__(self):
+        self.counters = {}
+
+    def add(self, stage, bounce, seconds, rays = 0, hits = 0):
+        counter = self.counters.setdefault((stage, bounce), [0., 0, 0])
+        counter[0] += seconds
+        counter[1] += rays
+        counter[2] += int(hits)
+
+    def report(self):
+        # frame stages first, then the ray stages by bounce
+        keys = sorted(self.counters, key=lambda k: (k[1] is not None, k[1] or 0, STAGES.index(k[0])))
+        return [{"stage": stage, "bounce": bounce, "seconds": self.counters[(stage, bounce)][0],
+                 "rays": self.counters[(stage, bounce)][1], "hits": self.counters[(stage, bounce)][2]}
+                for (stage, bounce) in keys]
+
+    def lines(self):
+        return ["%-9s %2s %8.1f ms %9d rays %9d hits" % (row["stage"], "" if row["bounce"] is None else row["bounce"],
+                                                          1000 * row["seconds"], row["rays"], row["hits"])
+                for row in self.report()]
+
+stats = None                # a Stats while enabled
+
+def enable_stats(on = True):
+    global stats
+    stats = Stats() if on else None
+
+LEAF_SIZE = 64              # max. number of objects in a BVH leaf
+
+def raytrace(O, D, scene, fb, pix, weight = 1.0, bounce = 0, hit_ids = None):
     # O is the ray origin, D is the normalized ray direction
-    # scene is a list of Sphere objects (see below)
+    # scene is a BVH built over the scene objects (see below)
+    # fb is the framebuffer, pix the pixel index of every ray in fb
+    # weight is the fraction of the ray color that reaches the pixel, a
+    # scalar or one throughput per ray
     # bounce is the number of the bounce, starting at zero for camera rays
+    # hit_ids, if given, receives the id of the object hit per pixel (-1 for none)
 
-    distances = [s.intersect(O, D) for s in scene]
-    nearest = reduce(np.minimum, distances)
-    color = rgb(0, 0, 0)
-    for (s, d) in zip(scene, distances):
-        hit = (nearest != FARAWAY) & (d == nearest)
-        if np.any(hit):
-            dc = extract(hit, d)
-            Oc = O.extract(hit)
-            Dc = D.extract(hit)
-            cc = s.light(Oc, Dc, dc, scene, bounce)
-            color += cc.place(hit)
-    return color
+    if stats is not None:
+        t0 = time.perf_counter()
+        nearest, ids, faces = scene.intersect(O, D)
+        stats.add("intersect", bounce, time.perf_counter() - t0, len(ids), np.count_nonzero(ids >= 0))
+    else:
+        nearest, ids, faces = scene.intersect(O, D)
+    if hit_ids is not None:
+        hit_ids[pix] = ids
+    if raylog is not None and bounce > 0:
+        raylog.add(O, D, nearest, pix)
+    for (i, idx) in scene.groups(ids):
+        w = weight if np.ndim(weight) == 0 else weight[idx]
+        scene.objects[i].light(O.take(idx), D.take(idx), nearest[idx], scene, fb, pix[idx], w, bounce, faces[idx])
+
+class BVHNode:
+    def __init__(self, lo, hi, groups = None, left = None, right = None, axis = 0):
+        self.lo = lo                # lower corner of the bounding box
+        self.hi = hi                # upper corner of the bounding box
+        self.groups = groups        # packed objects, only set for leaves (see pack)
+        self.left = left            # children, left is below right along axis
+        self.right = right
+        self.axis = axis
+
+    def children(self, D):
+        # both children, the one the rays D enter first (on average) last,
+        # so that it is popped first from the traversal stack
+        if D.v.ndim == 1 or D.v[:, self.axis].sum() >= 0:
+            return (self.right, self.left)
+        return (self.left, self.right)
+
+class BVH:
+    # Bounding volume hierarchy over the scene objects. Objects without
+    # bounds (e.g. the infinite CheckeredPlane) are tested against every ray.
+    # The objects of a leaf, and the unbounded ones, are packed into one group
+    # per primitive type, intersected with one broadcast per group.
+    def __init__(self, objects, leaf_size = LEAF_SIZE):
+        self.objects = objects
+        self.leaf_size = leaf_size
+        unbounded = []
+        bounded = []
+        self.lo = np.zeros((len(objects), 3), dtype=DTYPE)
+        self.hi = np.zeros((len(objects), 3), dtype=DTYPE)
+        for (i, s) in enumerate(objects):
+            b = s.bounds()
+            if b is None:
+                unbounded.append(i)
+            else:
+                (self.lo[i], self.hi[i]) = b
+                bounded.append(i)
+        self.unbounded = self.pack(unbounded)
+        self.root = self.build(np.array(bounded, dtype=int)) if bounded else None
+        self.ids = {id(s): i for (i, s) in enumerate(objects)}
+
+    def build(self, ids):
+        lo = self.lo[ids].min(axis=0)
+        hi = self.hi[ids].max(axis=0)
+        if len(ids) <= self.leaf_size:
+            return BVHNode(lo, hi, groups=self.pack(ids))
+
+        # split at the median centroid along the axis of largest extent
+        centroids = (self.lo[ids] + self.hi[ids]) * 0.5
+        axis = np.argmax(centroids.max(axis=0) - centroids.min(axis=0))
+        order = ids[np.argsort(centroids[:, axis], kind='stable')]
+        half = len(order) // 2
+        return BVHNode(lo, hi, left=self.build(order[:half]), right=self.build(order[half:]), axis=axis)
+
+    def pack(self, ids):
+        return pack(self.objects, ids)
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def index(self, s):
+        return self.ids[id(s)]
+
+    def intersect(self, O, D):
+        # returns the nearest distance, the id of the nearest object and the
+        # id of the face hit if that is a mesh (-1 otherwise) per ray
+        n = np.broadcast_shapes(O.v.shape, D.v.shape)[0]
+        nearest = np.full(n, FARAWAY, dtype=DTYPE)
+        ids = np.full(n, -1)
+        faces = np.full(n, -1)
+        for group in self.unbounded:
+            group.update(np.arange(n), O, D, nearest, ids, faces)
+        if self.root is None:
+            return nearest, ids, faces
+
+        with np.errstate(divide='ignore'):
+            invD = as_vec3(1 / D.v)
+
+        # every stack entry carries the rays (and their indices) that reached the node
+        stack = [(self.root, np.arange(n), O, D, invD)]
+        while stack:
+            (node, idx, Oi, Di, invDi) = stack.pop()
+            hit = self.hits_box(node, Oi, invDi, nearest[idx])
+            if not hit.all():
+                (idx, Oi, Di, invDi) = (idx[hit], Oi.extract(hit), Di.extract(hit), invDi.extract(hit))
+            if len(idx) == 0:
+                continue
+            if node.groups is not None:
+                for group in node.groups:
+                    group.update(idx, Oi, Di, nearest, ids, faces)
+            else:
+                stack.extend((child, idx, Oi, Di, invDi) for child in node.children(Di))
+        return nearest, ids, faces
+
+    def occluded(self, O, D, maxdist, exclude = -1):
+        # any-hit query: True for every ray that hits an object other than
+        # exclude closer than maxdist, only objects that cannot shadow
+        # themselves may be excluded (see SceneObject.shadows_itself). The
+        # search distance of a ray drops to -1 as soon as one blocker is
+        # found, which removes the ray from all further box and object tests.
+        n = np.broadcast_shapes(O.v.shape, D.v.shape)[0]
+        limit = np.array(maxdist, dtype=DTYPE)
+        idx = np.arange(n)
+        for group in self.unbounded:
+            group.block(exclude, idx, O, D, limit)
+        if self.root is not None:
+            with np.errstate(divide='ignore'):
+                invD = as_vec3(1 / D.v)
+            stack = [(self.root, idx, O, D, invD)]
+            while stack:
+                (node, idx, Oi, Di, invDi) = stack.pop()
+                hit = self.hits_box(node, Oi, invDi, limit[idx])
+                if not hit.all():
+                    (idx, Oi, Di, invDi) = (idx[hit], Oi.extract(hit), Di.extract(hit), invDi.extract(hit))
+                if len(idx) == 0:
+                    continue
+                if node.groups is not None:
+                    for group in node.groups:
+                        group.block(exclude, idx, Oi, Di, limit)
+                else:
+                    stack.extend((child, idx, Oi, Di, invDi) for child in node.children(Di))
+        return limit < 0
+
+    @staticmethod
+    def hits_box(node, O, invD, nearest):
+        # slab test of the rays against the bounding box of the node
+        if len(nearest) < 4096:
+            # few rays: fewer numpy calls on the (n, 3) buffers
+            with np.errstate(invalid='ignore'):
+                t0 = (node.lo - O.v) * invD.v
+                t1 = (node.hi - O.v) * invD.v
+                tmin = np.fmin(t0, t1).max(axis=-1)
+                tmax = np.fmax(t0, t1).min(axis=-1)
+            return np.maximum(tmin, 0, out=tmin) <= np.minimum(tmax, nearest, out=tmax)
+
+        # many rays: one axis at a time to keep the temporaries small
+        tmin = np.zeros(len(nearest), dtype=nearest.dtype)
+        tmax = nearest.copy()
+        with np.errstate(invalid='ignore'):
+            for (o, inv, lo, hi) in zip(O.components(), invD.components(), node.lo, node.hi):
+                t0 = (lo - o) * inv
+                t1 = (hi - o) * inv
+                np.fmax(tmin, np.fmin(t0, t1), out=tmin)
+                np.fmin(tmax, np.fmax(t0, t1, out=t0), out=tmax)
+        return tmin <= tmax
+
+    def groups(self, ids):
+        # yields every hit object id together with the indices of the rays hitting it
+        order = np.argsort(ids, kind='stable')
+        (objects, starts) = np.unique(ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for (i, start, end) in zip(objects, starts, ends):
+            if i >= 0:
+                yield (i, order[start:end])
+
+TEXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "08_textures_and_shadows")
+
+class Texture:
+    # Image texture, for the diffuse color of a primitive (see
+    # SceneObject.diffusecolor). The mip pyramid is built once, every level
+    # averages 2x2 texels of the one before, down to 1x1, and all levels are
+    # kept in one flat array of 8 bit texels, so that lookup() filters a
+    # whole batch of hits, each in its own levels, with a few gathers.
+    def __init__(self, image):
+        level = np.asarray(image, dtype=np.float32)     # (h, w, 3) in 0..255
+        levels = [level]
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            if level.shape[0] > 1:
+                if level.shape[0] % 2:
+                    level = np.concatenate((level, level[-1:]))
+                level = (level[0::2] + level[1::2]) * .5
+            if level.shape[1] > 1:
+                if level.shape[1] % 2:
+                    level = np.concatenate((level, level[:, -1:]), axis=1)
+                level = (level[:, 0::2] + level[:, 1::2]) * .5
+            levels.append(level)
+        self.texels = np.concatenate([np.round(l).reshape((-1, 3)) for l in levels]).astype(np.uint8)
+        self.heights = np.array([l.shape[0] for l in levels])
+        self.widths = np.array([l.shape[1] for l in levels])
+        self.offsets = np.cumsum([0] + [l.shape[0] * l.shape[1] for l in levels[:-1]])
+        self.size = max(levels[0].shape[:2])
+        self.digest = hashlib.blake2b(self.texels.tobytes(), digest_size=16).digest()   # see frame_key
+
+    def lookup(self, u, v, footprint):
+        # trilinear filtering: bilinear lookups at the texture coordinates u, v
+        # (repeating, v = 0 at the top) in the two levels with texels closest
+        # in size to footprint, the size of a pixel in texture coordinates
+        level = np.log2(np.maximum(footprint * self.size, 1))
+        level = np.minimum(np.broadcast_to(level, np.shape(u)), len(self.offsets) - 1)
+        lower = level.astype(int)
+        color = self.bilinear(u, v, lower)
+        blend = level - lower
+        mixed = np.flatnonzero(blend > 0)       # only these need the next level, too
+        if len(mixed):
+            upper = self.bilinear(u[mixed], v[mixed], lower[mixed] + 1)
+            upper -= color[mixed]
+            upper *= blend[mixed, np.newaxis].astype(np.float32)
+            color[mixed] += upper
+        color *= 1 / 255
+        return as_vec3(color.astype(DTYPE, copy=False))
+
+    def bilinear(self, u, v, level):
+        # texels of the levels (one per point) as float32 in 0..255
+        (w, h) = (self.widths[level], self.heights[level])
+        (x, y) = (u * w - .5, v * h - .5)
+        (x0, y0) = (np.floor(x), np.floor(y))
+        (fx, fy) = ((x - x0).astype(np.float32)[:, np.newaxis], (y - y0).astype(np.float32)[:, np.newaxis])
+        x0 = x0.astype(int) % w
+        x1 = (x0 + 1) % w
+        row0 = self.offsets[level] + (y0.astype(int) % h) * w
+        row1 = self.offsets[level] + ((y0.astype(int) + 1) % h) * w
+        top = np.take(self.texels, row0 + x0, axis=0).astype(np.float32)
+        right = np.take(self.texels, row0 + x1, axis=0).astype(np.float32)
+        right -= top
+        right *= fx
+        top += right                            # lerp along x in the upper row,
+        bottom = np.take(self.texels, row1 + x0, axis=0).astype(np.float32)
+        right = np.take(self.texels, row1 + x1, axis=0).astype(np.float32)
+        right -= bottom
+        right *= fx
+        bottom += right                         # in the lower row,
+        bottom -= top
+        bottom *= fy
+        top += bottom                           # and between the rows
+        return top
+
+def load_texture(filename):
+    # loads an image file (relative to TEXTURE_DIR) as a Texture, PIL is only needed here
+    from PIL import Image
+    with Image.open(os.path.join(TEXTURE_DIR, filename)) as image:
+        return Texture(np.asarray(image.convert("RGB")))
+
+pixel_spread = 0.           # angle between the camera rays of neighbouring pixels, see set_pixel_spread
+
+class SceneObject:
+    # Shading shared by all primitives. Subclasses provide intersect, bounds
+    # and normal, and may override lambert and diffusecolor. A Texture as
+    # diffuse color needs uv, the texture coordinates of points on the object.
+    # Only objects that cannot shadow themselves, convex or flat ones, are
+    # excluded from their own shadow rays (Sphere, CheckeredPlane and
+    # Triangle). All others, meshes included, rely on the nudged origins.
+    shadows_itself = True
+
+    def lambert(self, N, toL):
+        lv = N.dot(toL)
+        return np.maximum(lv, 0, out=lv)
+
+    def diffusecolor(self, M, d = None):
+        # the diffuse color at the points M, looked up in the mip level that
+        # matches the size of a pixel at the distances d from the ray origins
+        # if it is a Texture (the finest level without d)
+        if isinstance(self.diffuse, Texture):
+            (u, v, extent) = self.uv(M)
+            return self.diffuse.lookup(u, v, 0. if d is None else d * (pixel_spread / extent))
+        return self.diffuse
+
+    def hit(self, O, D):
+        # the distances of intersect and the faces hit, None if the object has no faces
+        return (self.intersect(O, D), None)
+
+    def occludes(self, O, D, maxdist):
+        # True for the rays that hit the object closer than maxdist
+        return self.intersect(O, D) < maxdist
+
+    def points(self):
+        # (k, 3) positions moved by scene transforms, see apply_transform
+        return np.empty((0, 3), dtype=DTYPE)
+
+    def move(self, P):
+        pass
+
+    def astype(self, dtype):
+        # converts the float data of the object to dtype, see set_precision
+        for (name, value) in vars(self).items():
+            if isinstance(value, vec3):
+                setattr(self, name, as_vec3(value.v.astype(dtype)))
+            elif isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+                setattr(self, name, value.astype(dtype))
+
+    def light(self, O, D, d, scene, fb, pix, weight, bounce, face = None):
+        # shades the hits of the rays O + t * D at distance d and adds their
+        # color times weight to the framebuffer fb at the pixel indices pix,
+        # face are the faces hit if the object has faces (see hit)
+        if stats is not None:
+            t0 = time.perf_counter()
+        M = D * d                               # intersection point
+        M += O
+        N = self.normal(M, O, D, face)          # normal
+        nudged = N * nudge(M)                   # M nudged to avoid itself
+        nudged += M
+        diffuse = self.diffusecolor(M, d)
+        if stats is not None:
+            stats.add("shade", bounce, time.perf_counter() - t0)
+        if gbuffer is not None:
+            gbuffer.add(self, M, N, nudged, diffuse, pix, weight, bounce)
+        self.direct(M, N, nudged, scene, fb, pix, weight, bounce, diffuse)
+
+        # Reflection, traced only for the rays that carry weight
+        if bounce < integrator.max_depth and self.mirror > 0:
+            if stats is not None:
+                t0 = time.perf_counter()
+            keep, weight = integrator.survivors(weight * self.mirror, len(pix))
+            if keep is not None:
+                if len(keep) == 0:
+                    return
+                (D, N, nudged, pix) = (D.take(keep), N.take(keep), nudged.take(keep), pix[keep])
+            rayD = N * (-2 * D.dot(N))
+            rayD += D
+            rayD.normalize()
+            if stats is not None:
+                stats.add("reflect", bounce, time.perf_counter() - t0, len(pix))
+            raytrace(nudged, rayD, scene, fb, pix, weight, bounce + 1)
+
+    def direct(self, M, N, nudged, scene, fb, pix, weight, bounce = 0, diffuse = None, toO = None):
+        # ambient light plus the diffuse and specular light of all lights at
+        # the points M, diffuse and toO are the diffuse colors and directions
+        # to the eye if known already
+        if stats is not None:
+            t0 = time.perf_counter()
+            (shadow, rays, blocked) = (0., 0, 0)
+        if toO is None:
+            toO = (E - M).normalize()           # direction to ray origin
+        if diffuse is None:
+            diffuse = self.diffusecolor(M)
+        peak = diffuse.v.max(axis=-1)           # brightest diffuse channel
+        color = as_vec3(np.full(M.v.shape, .05, dtype=DTYPE))  # ambient
+
+        for light in lights:
+            toL = light.position - M            # direction to light
+            distL = np.sqrt(abs(toL))
+            toL.normalize()
+            lv = self.lambert(N, toL)
+
+            # Culling: points facing away from the light get none of it, and
+            # points it lights too faintly to matter, even with a full
+            # highlight, are taken as unlit without casting a shadow ray
+            bound = lv * peak
+            bound += 1
+            falloff = light.falloff(distL)
+            if falloff is not None:
+                bound *= falloff
+            bound *= light.color.v.max()
+            near = np.flatnonzero((lv > 0) & (bound >= LIGHT_CUTOFF))
+            if len(near) == 0:
+                continue
+
+            # Shadow: the remaining points see the light unless another object blocks it
+            if stats is not None:
+                t1 = time.perf_counter()
+            exclude = -1 if self.shadows_itself else scene.index(self)
+            seen = ~scene.occluded(nudged.take(near), toL.take(near), distL[near], exclude)
+            if raylog is not None:
+                raylog.add(nudged.take(near), toL.take(near), distL[near], pix[near])
+            if stats is not None:
+                shadow += time.perf_counter() - t1
+                (rays, blocked) = (rays + len(near), blocked + len(near) - np.count_nonzero(seen))
+            lit = near[seen]
+
+            # Lambert shading (diffuse) plus Blinn-Phong shading (specular), a white highlight
+            (Nl, toLl) = (N.take(lit), toL.take(lit))
+            half = toO.take(lit) + toLl
+            phong = Nl.dot(half.normalize())
+            np.clip(phong, 0, 1, out=phong)
+            np.power(phong, 50, out=phong)
+            shade = diffuse.take(lit) * lv[lit]
+            shade += phong
+            if falloff is not None:
+                shade *= falloff[lit]
+            shade *= light.color
+            color.v[lit] += shade.v
+
+        color *= weight
+        fb.v[pix] += color.v
+        if stats is not None:
+            stats.add("shadow", bounce, shadow, rays, blocked)
+            stats.add("shade", bounce, time.perf_counter() - t0 - shadow, len(pix), rays - blocked)
+
+class Sphere(SceneObject):
+    shadows_itself = False
 
-class Sphere:
     def __init__(self, center, r, diffuse, mirror = 0.5):
         self.c = center
         self.r = r
@@ -75,8 +621,9 @@ class Sphere:
         self.mirror = mirror
 
     def intersect(self, O, D):
-        b = 2 * D.dot(O - self.c)
-        c = abs(self.c) + abs(O) - 2 * self.c.dot(O) - (self.r * self.r)
+        oc = O - self.c
+        b = 2 * D.dot(oc)
+        c = abs(oc) - (self.r * self.r)
         disc = (b ** 2) - (4 * c)
         sq = np.sqrt(np.maximum(0, disc))
         h0 = (-b - sq) / 2
@@ -85,44 +632,32 @@ class Sphere:
         pred = (disc > 0) & (h > 0)
         return np.where(pred, h, FARAWAY)
 
-    def diffusecolor(self, M):
-        return self.diffuse
+    def bounds(self):
+        c = self.c.array()
+        return (c - self.r, c + self.r)
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)                         # intersection point
-        N = (M - self.c) * (1. / self.r)        # normal
-        toL = (L - M).norm()                    # direction to light
-        toO = (E - M).norm()                    # direction to ray origin
-        nudged = M + N * .0001                  # M nudged to avoid itself
-
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
-
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
-
-        # Lambert shading (diffuse)
-        lv = np.maximum(N.dot(toL), 0)
-        color += self.diffusecolor(M) * lv * seelight
-
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
-
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
+    def normal(self, M, O, D, face = None):
+        N = M - self.c
+        N *= 1. / self.r
+        return N
+
+    def uv(self, M):
+        # spherical coordinates: u around the y axis, v from the top, one unit
+        # of v spans half the circumference
+        N = self.normal(M, None, None).v
+        u = np.arctan2(N[:, 2], N[:, 0]) * (.5 / np.pi) + .5
+        v = np.arccos(np.clip(N[:, 1], -1, 1)) * (1 / np.pi)
+        return (u, v, np.pi * self.r)
     
-    def rotate(self, pos, neg):       
-        newCenter = rotate_obj(self.c, pos, neg)
-        self.c = vec3(newCenter[0], newCenter[1], newCenter[2])
+    def points(self):
+        return self.c.array()[np.newaxis]
+
+    def move(self, P):
+        self.c = vec3(*P[0])
+
+class CheckeredPlane(SceneObject):
+    shadows_itself = False
 
-class CheckeredPlane:
     def __init__(self, center, normal, diffuse, mirror=0.05):
         self.c = center
         self.n = normal
@@ -134,44 +669,29 @@ class CheckeredPlane:
         t = -self.n.dot(co) / self.n.dot(D)
         return np.where((t > 0), t, FARAWAY)
 
-    def diffusecolor(self, M):
+    def bounds(self):
+        return None                             # infinite plane
+
+    def diffusecolor(self, M, d = None):
+        if isinstance(self.diffuse, Texture):
+            return super().diffusecolor(M, d)
         checker = (np.ceil((M.x * 2)) % 2) == (np.ceil((M.z * 2)) % 2)
         return self.diffuse * checker
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)                         # intersection point
-        N = self.n                              # normal
-        toL = (L - M).norm()                    # direction to light
-        toO = (E - M).norm()                    # direction to ray origin
-        nudged = M + N * .0001                  # M nudged to avoid itself
-
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
-
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
-
-        # Lambert shading (diffuse)
-        lv = np.maximum(N.dot(toL), 0)
-        color += self.diffusecolor(M) * lv * seelight
-
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
-
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
-    
-    def rotate(self, pos, neg):
-        pass
+    def normal(self, M, O, D, face = None):
+        return self.n
+
+    def uv(self, M):
+        # planar coordinates along two axes in the plane, the texture repeats every world unit
+        n = self.n.v
+        t = np.cross(n, (1, 0, 0) if abs(n[0]) < .9 else (0, 1, 0))
+        t /= np.linalg.norm(t)
+        P = (M - self.c).v
+        return (P @ t, P @ np.cross(n, t), 1.)
+
+class Triangle(SceneObject):
+    shadows_itself = False
 
-class Triangle:
     def __init__(self, a, b, c, diffuse, mirror = 0.5):
         self.a = a
         self.b = b
@@ -184,76 +704,360 @@ class Triangle:
         v = self.c - self.a
         w = O - self.a
 
-        t = 1 / (D.cross(v).dot(u)) * (w.cross(u).dot(v))
-        r = 1 / (D.cross(v).dot(u)) * (D.cross(v).dot(w))
-        s = 1 / (D.cross(v).dot(u)) * (w.cross(u).dot(D))
+        p = D.cross(v)
+        q = w.cross(u)
+        det = 1 / p.dot(u)
+        t = det * q.dot(v)
+        r = det * p.dot(w)
+        s = det * q.dot(D)
 
         pred = (r >= 0) & (r <= 1) & (s >= 0) & (s <= 1) & (r + s <= 1) & (t > 0)
         return np.where(pred, t, FARAWAY)
 
-    def diffusecolor(self, M):
-        return self.diffuse
+    def bounds(self):
+        vertices = np.array([self.a.array(), self.b.array(), self.c.array()])
+        return (vertices.min(axis=0), vertices.max(axis=0))
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)                         # intersection point
-        N = self.a.cross(self.b)                # normal
-        toL = (L - M).norm()                    # direction to light
-        toO = (E - M).norm()                    # direction to ray origin
-        nudged = M + N * .0001                  # M nudged to avoid itself
-
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
-
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
-
-        # Lambert shading (diffuse)
-        lv = np.abs(N.dot(toL))
-        color += self.diffusecolor(M) * lv * seelight
-
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
-
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
+    def normal(self, M, O, D, face = None):
+        return self.a.cross(self.b)
+
+    def uv(self, M):
+        # barycentric coordinates: a at (0, 0), b at (1, 0) and c at (0, 1)
+        (e1, e2, P) = (self.b - self.a, self.c - self.a, M - self.a)
+        (d11, d12, d22) = (e1.dot(e1), e1.dot(e2), e2.dot(e2))
+        (p1, p2) = (P.dot(e1), P.dot(e2))
+        det = d11 * d22 - d12 * d12
+        return ((d22 * p1 - d12 * p2) / det, (d11 * p2 - d12 * p1) / det, np.sqrt(np.sqrt(det)))
+
+    def lambert(self, N, toL):
+        lv = N.dot(toL)
+        return np.abs(lv, out=lv)
     
-    def rotate(self, pos, neg):       
-        newA = rotate_obj(self.a, pos, neg)
-        self.a = vec3(newA[0], newA[1], newA[2])
-
-        newB = rotate_obj(self.b, pos, neg)
-        self.b = vec3(newB[0], newB[1], newB[2])
-
-        newC = rotate_obj(self.c, pos, neg)
-        self.c = vec3(newC[0], newC[1], newC[2])
-        
-
-def rotate_obj(vec, pos, neg):
-    if pos:
-        cos_theta = np.cos(np.pi / 10)
-        sin_theta = np.sin(np.pi / 10)
-    elif neg:
-        cos_theta = np.cos(-np.pi / 10)
-        sin_theta = np.sin(-np.pi / 10)
-
-    T = np.array([  [1, 0, 0, 0],
-                    [0, 1, 0, 0],
-                    [0, 0, 1, -2.25],
-                    [0, 0, 0, 1]])
 
+    def points(self):
+        return np.array([self.a.array(), self.b.array(), self.c.array()])
+
+    def move(self, P):
+        (self.a, self.b, self.c) = (vec3(*p) for p in P)
+
+MESH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "04_triangle-meshes-and-shading", "meshes")
+MESH_BATCH = 1 << 19        # max. number of ray/face pairs tested at once
+
+def load_obj(filename):
+    # returns the vertex positions and the (fan-triangulated) faces of an obj file
+    positions = []
+    faces = []
+    with open(filename, "r") as file:
+        for line in file:
+            if line.startswith("v "): # add vertices
+                positions.append(list(map(float, line[1:].split()[:3])))
+            elif line.startswith("f "): # add faces, ignore texture and normal indices
+                index = [int(i.split("/")[0]) for i in line[1:].split()]
+                index = [i - 1 if i > 0 else len(positions) + i for i in index]
+                for k in range(1, len(index) - 1):
+                    faces.append([index[0], index[k], index[k + 1]])
+    return np.array(positions, dtype=float), np.array(faces, dtype=int)
+
+def load_mesh(filename, center, size, diffuse, mirror = 0.2):
+    # loads an obj file (relative to MESH_DIR) and fits it into a cube of edge length size around center
+    vertices, faces = load_obj(os.path.join(MESH_DIR, filename))
+    lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+    vertices = (vertices - (lo + hi) / 2) * (size / np.max(hi - lo)) + center.array()
+    return TriangleMesh(vertices, faces, diffuse, mirror)
+
+class Faces:
+    # Triangles with the corners a, b and c ((m, 3) each) packed for a
+    # batched Moeller-Trumbore test, with the per face terms factored out,
+    # so that a ray batch is tested against all faces with matrix products
+    def __init__(self, a, b, c):
+        e1, e2 = b - a, c - a                               # edges per face
+        n = np.cross(e1, e2)
+        self.nt = np.ascontiguousarray(n.T)
+        self.e1t = np.ascontiguousarray(e1.T)
+        self.e2t = np.ascontiguousarray(e2.T)
+        self.e2xat = np.ascontiguousarray(np.cross(e2, a).T)
+        self.axe1t = np.ascontiguousarray(np.cross(a, e1).T)
+        self.an = np.einsum('ij,ij->i', a, n)
+
+    def __len__(self):
+        return len(self.an)
+
+    def take(self, ids):
+        # the faces ids only
+        faces = Faces.__new__(Faces)
+        for (name, value) in vars(self).items():
+            setattr(faces, name, np.ascontiguousarray(value[..., ids]))
+        return faces
+
+    def distances(self, O, D):
+        # yields the ray chunks and the (rays, faces) matrix of hit
+        # distances, FARAWAY where a ray misses a face
+        count = np.broadcast_shapes(O.v.shape, D.v.shape)[0]
+        chunk = max(1, MESH_BATCH // len(self))
+        for start in range(0, count, chunk):
+            rays = slice(start, start + chunk)
+            Oc = O.v if O.v.ndim == 1 else O.v[rays]
+            Dc = D.v[rays]
+            OxD = np.cross(Oc, Dc)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                det = Dc @ self.nt                          # -det, det = (D x e2) . e1
+                np.divide(-1, det, out=det)
+                u = OxD @ self.e2t                          # u = ((O - a) . (D x e2)) / det
+                u -= Dc @ self.e2xat
+                u *= det
+                v = OxD @ self.e1t                          # v = (D . ((O - a) x e1)) / det
+                v += Dc @ self.axe1t
+                v *= det
+                np.negative(v, out=v)
+                t = Oc @ self.nt - self.an                  # t = (e2 . ((O - a) x e1)) / det
+                t = t * det
+                pred = (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+            t[~pred] = FARAWAY
+            yield (rays, t)
+
+class TriangleMesh(SceneObject):
+    def __init__(self, vertices, faces, diffuse, mirror = 0.2):
+        self.vertices = np.asarray(vertices, dtype=DTYPE)  # (n, 3) vertex positions
+        self.faces = np.asarray(faces, dtype=int)          # (m, 3) vertex indices
+        self.diffuse = diffuse
+        self.mirror = mirror
+        self.update()
+
+    def update(self):
+        # precompute the packed per face data, the BVH over the faces is
+        # built again when it is needed next
+        a, b, c = (self.vertices[self.faces[:, i]] for i in range(3))
+        self.packed = Faces(a, b, c)
+        n = self.packed.nt.T
+        self.n = as_vec3(n / np.linalg.norm(n, axis=1)[:, np.newaxis])
+        self.tree = None
+
+    def face_tree(self):
+        if self.tree is None:
+            self.tree = FaceBVH(self)
+        return self.tree
+
+    def hit(self, O, D):
+        nearest, face, _ = self.face_tree().intersect(O, D)
+        return (nearest, face)
+
+    def occludes(self, O, D, maxdist):
+        return self.face_tree().occluded(O, D, maxdist)
+
+    def intersect(self, O, D):
+        return self.hit(O, D)[0]
+
+    def bounds(self):
+        return (self.vertices.min(axis=0), self.vertices.max(axis=0))
+
+    def normal(self, M, O, D, face = None):
+        N = self.n.take(face)                   # face normal,
+        N *= np.where(N.dot(D) > 0, -1., 1.)    # facing the ray
+        return N
+
+    def uv(self, M):
+        # planar projection along the axis in which the mesh is thinnest, the
+        # texture spans the larger of the two other extents once
+        (lo, hi) = self.bounds()
+        (a, b) = np.delete(np.arange(3), np.argmin(hi - lo))
+        extent = max(hi[a] - lo[a], hi[b] - lo[b])
+        return ((M.v[:, a] - lo[a]) / extent, (hi[b] - M.v[:, b]) / extent, extent)
+
+    def points(self):
+        return self.vertices
+
+    def move(self, P):
+        self.vertices = P
+        self.update()
+
+    def astype(self, dtype):
+        super().astype(dtype)
+        self.update()
+
+    def __getstate__(self):
+        # without the derived per face data, rebuilt by update
+        return {name: vars(self)[name] for name in ("vertices", "faces", "diffuse", "mirror")}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.update()
+
+class PackedGroup:
+    # Objects of one primitive type packed into arrays. Subclasses yield
+    # the (rays, objects) matrices of hit distances, FARAWAY for misses.
+    def __init__(self, ids):
+        self.ids = np.asarray(ids)  # object ids of the columns
+
+    def update(self, idx, O, D, nearest, ids, faces):
+        # O and D are the rays selected by idx
+        for (rays, t) in self.distances(O, D):
+            j = np.argmin(t, axis=1)
+            d = t[np.arange(len(j)), j]
+            sel = idx[rays]
+            closer = d < nearest[sel]
+            sel = sel[closer]
+            nearest[sel] = d[closer]
+            ids[sel] = self.ids[j[closer]]
+            faces[sel] = -1
+
+    def block(self, exclude, idx, O, D, limit):
+        # O and D are the rays selected by idx, the ones blocked by an object
+        # other than exclude get a search distance of -1
+        excluded = np.flatnonzero(self.ids == exclude)
+        for (rays, t) in self.distances(O, D):
+            t[:, excluded] = FARAWAY
+            sel = idx[rays]
+            hit = (t < limit[sel, np.newaxis]).any(axis=1)
+            limit[sel[hit]] = -1
+
+class ObjectGroup(PackedGroup):
+    # a single object of any other type, intersected through its own methods
+    def __init__(self, objects, ids):
+        super().__init__(ids)
+        self.object = objects[ids[0]]
+
+    def distances(self, O, D):
+        yield (slice(None), self.object.intersect(O, D)[:, np.newaxis])
+
+    def update(self, idx, O, D, nearest, ids, faces):
+        (d, face) = self.object.hit(O, D)
+        closer = d < nearest[idx]
+        sel = idx[closer]
+        nearest[sel] = d[closer]
+        ids[sel] = self.ids[0]
+        faces[sel] = -1 if face is None else face[closer]
+
+    def block(self, exclude, idx, O, D, limit):
+        if self.ids[0] != exclude:
+            hit = self.object.occludes(O, D, limit[idx])
+            limit[idx[hit]] = -1
+
+PACK_BATCH = 1 << 14        # ray/object pairs per chunk, small enough to stay in cache
+
+def ray_chunks(O, D, k):
+    # slices of the rays in chunks of at most PACK_BATCH ray/object pairs,
+    # with the origins and directions of each chunk
+    count = np.broadcast_shapes(O.v.shape, D.v.shape)[0]
+    chunk = max(1, PACK_BATCH // k)
+    for start in range(0, count, chunk):
+        rays = slice(start, start + chunk)
+        yield (rays, O.v if O.v.ndim == 1 else O.v[rays], D.v[rays])
+
+class SphereGroup(PackedGroup):
+    def __init__(self, objects, ids):
+        super().__init__(ids)
+        self.c = np.array([objects[i].c.v for i in ids])
+        self.ct = np.ascontiguousarray(self.c.T)
+        r = np.array([objects[i].r for i in ids], dtype=self.c.dtype)
+        self.r2 = r * r
+        self.cc = np.einsum('ij,ij->i', self.c, self.c) - self.r2  # |c|^2 - r^2
+
+    def distances(self, O, D):
+        # Sphere.intersect for all spheres at once, with |O - c|^2 and
+        # D . (O - c) expanded into products with the packed centers
+        for (rays, Oc, Dc) in ray_chunks(O, D, len(self.ids)):
+            if Oc.ndim == 1:
+                oc = Oc - self.c
+                b = Dc @ oc.T
+                c = np.einsum('ij,ij->i', oc, oc) - self.r2
+            else:
+                b = np.einsum('ij,ij->i', Dc, Oc)[:, np.newaxis] - Dc @ self.ct
+                c = Oc @ self.ct
+                c *= -2
+                c += np.einsum('ij,ij->i', Oc, Oc)[:, np.newaxis]
+                c += self.cc
+            b *= 2
+            disc = b * b - 4 * c
+            sq = np.sqrt(np.maximum(0, disc))
+            h0 = (-b - sq) / 2
+            h1 = (-b + sq) / 2
+            h = np.where((h0 > 0) & (h0 < h1), h0, h1)
+            yield (rays, np.where((disc > 0) & (h > 0), h, FARAWAY))
+
+class PlaneGroup(PackedGroup):
+    def __init__(self, objects, ids):
+        super().__init__(ids)
+        c = np.array([objects[i].c.v for i in ids])
+        self.nt = np.ascontiguousarray(np.array([objects[i].n.v for i in ids]).T)
+        self.nc = np.einsum('ij,ji->i', c, self.nt)                  # n . c
+
+    def distances(self, O, D):
+        # CheckeredPlane.intersect for all planes at once
+        for (rays, Oc, Dc) in ray_chunks(O, D, len(self.ids)):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (self.nc - Oc @ self.nt) / (Dc @ self.nt)
+            yield (rays, np.where(t > 0, t, FARAWAY))
+
+class TriangleGroup(PackedGroup):
+    def __init__(self, objects, ids):
+        super().__init__(ids)
+        self.faces = Faces(*(np.array([getattr(objects[i], k).v for i in ids]) for k in "abc"))
+
+    def distances(self, O, D):
+        # Triangle.intersect for all triangles at once
+        return self.faces.distances(O, D)
+
+class FaceGroup(PackedGroup):
+    # faces of one mesh, the ids are face ids
+    def __init__(self, faces, ids):
+        super().__init__(ids)
+        self.faces = faces.take(ids)
+
+    def distances(self, O, D):
+        return self.faces.distances(O, D)
+
+class FaceBVH(BVH):
+    # BVH over the faces of a TriangleMesh, its object ids are face ids
+    def __init__(self, mesh, leaf_size = LEAF_SIZE):
+        corners = mesh.vertices[mesh.faces]
+        self.objects = mesh.packed
+        self.leaf_size = leaf_size
+        self.lo = corners.min(axis=1)
+        self.hi = corners.max(axis=1)
+        self.unbounded = []
+        self.root = self.build(np.arange(len(corners))) if len(corners) else None
+
+    def pack(self, ids):
+        return [FaceGroup(self.objects, ids)]
+
+PACKED = {Sphere: SphereGroup, CheckeredPlane: PlaneGroup, Triangle: TriangleGroup}
+
+def pack(objects, ids):
+    # groups the objects ids by primitive type, one group per type in PACKED
+    # and one per object of any other type, or the only one of its type
+    kinds = {}
+    for i in ids:
+        kinds.setdefault(PACKED.get(type(objects[i]), ObjectGroup), []).append(i)
+    groups = []
+    for (kind, members) in kinds.items():
+        if kind is ObjectGroup or len(members) == 1:
+            groups.extend(ObjectGroup(objects, [i]) for i in members)
+        else:
+            groups.append(kind(objects, members))
+    return groups
+
+ROTATION_STEP = np.pi / 10                  # angle of one rotation step
+PIVOT = np.array([0, 0, 2.25])              # rotations turn about the y axis through PIVOT
+
+def rotation(angle):
+    # 4x4 rotation about the y axis through PIVOT, precomposed as T^-1 R T
+    T = np.eye(4)
+    T[:3, 3] = -PIVOT
+    Tinv = np.eye(4)
+    Tinv[:3, 3] = PIVOT
+    cos_theta, sin_theta = np.cos(angle), np.sin(angle)
     R = np.array([  [cos_theta,   0,  sin_theta   , 0],
                     [0,           1,  0           , 0],
                     [-sin_theta,  0,  cos_theta   , 0],
                     [0,           0,  0           , 1]])
+    return Tinv @ R @ T
+
+def rotation_step(pos, neg):
+    return rotation(ROTATION_STEP if pos else -ROTATION_STEP if neg else 0.)
 
-    return (np.linalg.inv(T)@R@T@np.array([vec.x, vec.y, vec.z, 1]))[:3]
+def transform_points(M, P):
+    # applies the 4x4 transform M to the (..., 3) points P
+    return P @ M[:3, :3].T + M[:3, 3]
 
 scene = [
         Sphere(vec3(.75, .1, 2.25), .6, vec3(1, 0, 0), mirror=0.1), # red sphere (right)
@@ -263,23 +1067,736 @@ scene = [
         Triangle(vec3(-.75, .1, 2.25), vec3(.75, .1, 2.25), vec3(0, 1.25, 2.25), vec3(1, 1, 0))
         ]
 
-def render_scene(width, height, pos = False, neg = False):
-
-    if pos or neg:
-        for object in scene:
-            object.rotate(pos, neg)
+scene_transform = np.eye(4)     # composed transform applied to the scene so far
+pending_transform = np.eye(4)   # pushed onto the scene but not applied yet
+camera = np.eye(4)              # camera to world transform of the screen, see orbit_camera
 
+def screen(width, height):
     r = float(width) / height
     # Screen coordinates: x0, y0, x1, y1.
-    S = (-1, 1 / r + .25, 1, -1 / r + .25)
-    x = np.tile(np.linspace(S[0], S[2], width), height)
-    y = np.repeat(np.linspace(S[1], S[3], height), width)
+    return (-1, 1 / r + .25, 1, -1 / r + .25)
+
+primary_rays_cache = {}     # (width, height, eye) -> primary ray directions
+PRIMARY_RAYS_CACHED = 8     # max. number of cached resolutions
+PRIMARY_RAYS_MAX = 1 << 20  # larger frames compute the rays per tile instead
+
+def primary_rays(width, height):
+    # normalized directions of the rays from E through all pixels, rebuilt
+    # only when the resolution or the camera changes
+    key = (width, height, E.v.tobytes(), camera.tobytes(), DTYPE)
+    if key not in primary_rays_cache:
+        S = screen(width, height)
+        x = np.tile(np.linspace(S[0], S[2], width), height)
+        y = np.repeat(np.linspace(S[1], S[3], height), width)
+
+        D = rays_through(x, y)
+        D.v.setflags(write=False)       # shared by all frames
+        if len(primary_rays_cache) >= PRIMARY_RAYS_CACHED:
+            primary_rays_cache.pop(next(iter(primary_rays_cache)))
+        primary_rays_cache[key] = D
+    return primary_rays_cache[key]
+
+def clear_primary_rays():
+    primary_rays_cache.clear()
+
+def rays_through(x, y):
+    # normalized directions of the rays from E through the screen points x, y
+    Q = transform_points(camera, np.stack((x, y, np.zeros_like(x)), axis=-1))
+    D = as_vec3(Q.astype(DTYPE))        # screen points Q,
+    D -= E                              # turned into ray directions in place
+    return D.normalize()
+
+AA_SAMPLES = ((-.125, -.375), (.375, -.125), (.125, .375), (-.375, .125))  # rotated grid, in pixels
+AA_CONTRAST = .1            # color difference to a neighbour that marks an edge
+
+def edge_pixels(color, ids, contrast = AA_CONTRAST):
+    # True for the pixels of the (h, w) images color and ids whose right or
+    # lower neighbour shows another object or differs in color by more than contrast
+    edge = np.zeros(ids.shape, dtype=bool)
+    for axis in (0, 1):
+        n = ids.shape[axis]
+        (a, b) = (np.arange(n - 1), np.arange(1, n))
+        differs = np.take(ids, a, axis) != np.take(ids, b, axis)
+        differs |= np.abs(np.take(color, a, axis) - np.take(color, b, axis)).max(axis=-1) > contrast
+        edge[(slice(None),) * axis + (a,)] |= differs
+        edge[(slice(None),) * axis + (b,)] |= differs
+    return edge
+
+def set_precision(dtype):
+    # switches the whole pipeline, scene included, to float32 or float64
+    global DTYPE, E
+    DTYPE = np.dtype(dtype).type
+    E = as_vec3(E.v.astype(DTYPE))
+    for object in scene + lights:
+        object.astype(DTYPE)
+    clear_primary_rays()
+
+def set_pixel_spread(width, height):
+    # sets pixel_spread for width x height frames: the pixel size on the
+    # screen over the distance of the screen center from the eye
+    global pixel_spread
+    S = screen(width, height)
+    center = transform_points(camera, np.array([(S[0] + S[2]) / 2, (S[1] + S[3]) / 2, 0]))
+    pixel_spread = (S[2] - S[0]) / max(width - 1, 1) / np.linalg.norm(center - E.array())
+
+def tile_rays(width, height, tile):
+    # the primary ray directions of the pixels x0 <= x < x1, y0 <= y < y1
+    (x0, y0, x1, y1) = tile
+    if width * height > PRIMARY_RAYS_MAX:
+        S = screen(width, height)
+        x = np.tile(np.linspace(S[0], S[2], width)[x0:x1], y1 - y0)
+        y = np.repeat(np.linspace(S[1], S[3], height)[y0:y1], x1 - x0)
+        return rays_through(x, y)
+    D = primary_rays(width, height)
+    if tile != (0, 0, width, height):
+        D = as_vec3(D.v.reshape((height, width, 3))[y0:y1, x0:x1].reshape((-1, 3)))
+    return D
+
+def trace_tile(width, height, tile, world, aa = False):
+    # traces the pixels x0 <= x < x1, y0 <= y < y1 of a width x height frame
+    # and returns their colors as a (y1 - y0, x1 - x0, 3) float array
+    # aa adds AA_SAMPLES more rays for the pixels on edges, see edge_pixels
+    set_pixel_spread(width, height)
+    if aa:
+        return trace_tile_aa(width, height, tile, world)
+    (x0, y0, x1, y1) = tile
+    n = (y1 - y0) * (x1 - x0)
+    fb = as_vec3(np.zeros((n, 3), dtype=DTYPE))
+    D = timed("rays", tile_rays, width, height, tile)
+    raytrace(E, D, world, fb, np.arange(n))
+    return fb.v.reshape((y1 - y0, x1 - x0, 3))
+
+def trace_tile_aa(width, height, tile, world):
+    # Adaptive anti-aliasing. The first pass traces one ray per pixel and
+    # keeps the id of the object it hits, for the tile plus a one pixel
+    # border so that edges across tile borders are found too. The edge
+    # pixels then get AA_SAMPLES more rays each, so that the extra cost
+    # grows with the number of edge pixels and not with the resolution.
+    (x0, y0, x1, y1) = tile
+    outer = (max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, width), min(y1 + 1, height))
+    (X0, Y0, X1, Y1) = outer
+    n = (Y1 - Y0) * (X1 - X0)
+    fb = as_vec3(np.zeros((n, 3), dtype=DTYPE))
+    ids = np.full(n, -1)
+    D = timed("rays", tile_rays, width, height, outer)
+    raytrace(E, D, world, fb, np.arange(n), hit_ids=ids)
+
+    inner = (slice(y0 - Y0, y1 - Y0), slice(x0 - X0, x1 - X0))
+    edge = edge_pixels(fb.v.reshape((Y1 - Y0, X1 - X0, 3)), ids.reshape((Y1 - Y0, X1 - X0)))[inner]
+    color = np.ascontiguousarray(fb.v.reshape((Y1 - Y0, X1 - X0, 3))[inner])
+    (py, px) = np.nonzero(edge)
+    if len(py) == 0:
+        return color
+
+    S = screen(width, height)
+    (dx, dy) = ((S[2] - S[0]) / max(width - 1, 1), (S[3] - S[1]) / max(height - 1, 1))
+    samples = as_vec3(np.zeros((len(py), 3), dtype=DTYPE))
+    for (ox, oy) in AA_SAMPLES:
+        D = rays_through(S[0] + (px + x0 + ox) * dx, S[1] + (py + y0 + oy) * dy)
+        raytrace(E, D, world, samples, np.arange(len(py)))
+    samples.v += color[py, px]
+    color[py, px] = samples.v / (len(AA_SAMPLES) + 1)
+    return color
+
+def push_transform(M):
+    # composes M onto the pending scene transform
+    global pending_transform
+    pending_transform = M @ pending_transform
+
+def apply_transform():
+    # moves the points of all primitives by the pending transform in a single
+    # batched multiply, however many transforms were pushed since the last frame
+    global pending_transform, scene_transform
+    if (pending_transform == np.eye(4)).all():
+        return
+    points = [object.points() for object in scene]
+    moved = transform_points(pending_transform, np.concatenate(points)).astype(DTYPE)
+    for object, P in zip(scene, np.split(moved, np.cumsum([len(p) for p in points])[:-1])):
+        if len(P):
+            object.move(P)
+    scene_transform = pending_transform @ scene_transform
+    pending_transform = np.eye(4)
+
+def rotate_scene(pos = False, neg = False):
+    if pos or neg:
+        push_transform(rotation_step(pos, neg))
+
+def orbit_camera(pos = False, neg = False):
+    # the alternative to rotate_scene: leaves the geometry untouched and moves
+    # the eye and the screen around PIVOT the opposite way instead
+    if pos or neg:
+        orbit(rotation_step(pos, neg))
+
+def orbit(M):
+    # moves the eye and the screen by the inverse of the scene transform M
+    global E, camera
+    M = np.linalg.inv(M)
+    camera = M @ camera
+    E = vec3(*transform_points(M, E.array()))
+
+RAY_BYTES = 256             # peak memory per traced ray, measured on the built-in scene
+MEMORY_BUDGET = 256 << 20   # peak memory of the tracing temporaries in trace_chunked
+
+def chunks(width, height, budget = MEMORY_BUDGET):
+    # tiles of whole rows (or of a part of a row) with at most budget / RAY_BYTES pixels
+    size = max(1, budget // RAY_BYTES)
+    (w, rows) = (min(width, size), max(1, size // width))
+    return [(x0, y0, min(x0 + w, width), min(y0 + rows, height))
+            for y0 in range(0, height, rows) for x0 in range(0, width, w)]
+
+def trace_chunked(width, height, world, out = None, budget = MEMORY_BUDGET, aa = False):
+    # traces the frame chunk by chunk into the preallocated (height, width, 3)
+    # image out (float, or uint8 for 8 bit colors), so that the peak memory
+    # stays within budget plus out, whatever the resolution
+    if out is None:
+        out = np.empty((height, width, 3), dtype=DTYPE)
+    for (x0, y0, x1, y1) in chunks(width, height, budget):
+        if gbuffer is not None:
+            gbuffer.begin((x0, y0, x1, y1))
+        color = trace_tile(width, height, (x0, y0, x1, y1), world, aa)
+        store(out[y0:y1, x0:x1], color)
+    return out
+
+class GBuffer:
+    # Deferred shading. Records every shading point of a traced frame, the
+    # hits of the camera rays and of the reflected rays, with its object,
+    # normal, nudged position, diffuse color, direction to the eye, pixel and
+    # weight, chunk by chunk. Only direct() depends on the lights, so after they
+    # change shade() recomputes the image from these points with the shadow
+    # rays alone, without tracing any camera or reflected ray. finish() merges
+    # the points of every object and bounce into one batch, a pixel sees at
+    # most one object per bounce. Costs about 150 bytes per shading point.
+    def __init__(self, world):
+        self.world = world
+        self.chunks = []
+
+    def begin(self, tile):
+        self.chunks.append((tile, []))
+
+    def add(self, object, M, N, nudged, diffuse, pix, weight, bounce):
+        toO = (E - M).normalize()
+        self.chunks[-1][1].append((object, M, N, nudged, diffuse, toO, pix, weight, bounce))
+
+    def finish(self):
+        for (tile, points) in self.chunks:
+            batches = {}
+            for point in points:
+                batches.setdefault((id(point[0]), point[-1]), []).append(point)
+            points[:] = [batch[0] if len(batch) == 1 else merge_points(batch) for batch in batches.values()]
+
+    def shade(self, out):
+        for ((x0, y0, x1, y1), points) in self.chunks:
+            fb = as_vec3(np.zeros(((y1 - y0) * (x1 - x0), 3), dtype=DTYPE))
+            for (object, M, N, nudged, diffuse, toO, pix, weight, bounce) in points:
+                object.direct(M, N, nudged, self.world, fb, pix, weight, bounce, diffuse, toO)
+            color = fb.v.reshape((y1 - y0, x1 - x0, 3))
+            store(out[y0:y1, x0:x1], color)
+        return out
+
+def merge_points(batch):
+    # one G-buffer entry for the entries of the same object and bounce
+    sizes = [len(point[6]) for point in batch]
+    def cat(k):
+        return as_vec3(np.concatenate([np.broadcast_to(point[k].v, (n, 3)) for (point, n) in zip(batch, sizes)]))
+    weight = np.concatenate([np.broadcast_to(point[7], (n,)) for (point, n) in zip(batch, sizes)])
+    (object, bounce) = (batch[0][0], batch[0][-1])
+    return (object, cat(1), cat(2), cat(3), cat(4), cat(5), np.concatenate([point[6] for point in batch]), weight, bounce)
+
+gbuffer = None              # the GBuffer recorded while trace_deferred traces
+gbuffers = {}               # frame state without the lights -> GBuffer, see trace_deferred
+GBUFFERS_CACHED = 4         # max. number of kept G-buffers, one per preview scale
+
+def gbuffer_key(width, height):
+    # everything the shading points depend on, which is all but the lights
+    return (width, height, tuple(map(id, scene)), scene_transform.tobytes(), camera.tobytes(), E.v.tobytes(),
+            DTYPE, integrator.max_depth, integrator.threshold, integrator.roulette)
+
+def trace_deferred(width, height, out = None, budget = MEMORY_BUDGET):
+    # like trace_chunked, but keeps the G-buffer of the frame, and for a frame
+    # that differs from a kept one only in the lights just shades that G-buffer again
+    global gbuffer
+    if out is None:
+        out = np.empty((height, width, 3), dtype=DTYPE)
+    key = gbuffer_key(width, height)
+    if key in gbuffers:
+        return gbuffers[key].shade(out)
+    world = timed("bvh", BVH, scene)
+    gbuffer = GBuffer(world)
+    try:
+        trace_chunked(width, height, world, out, budget)
+    finally:
+        (recorded, gbuffer) = (gbuffer, None)
+    recorded.finish()
+    if len(gbuffers) >= GBUFFERS_CACHED:
+        gbuffers.pop(next(iter(gbuffers)))
+    gbuffers[key] = recorded
+    return out
+
+def clear_gbuffers():
+    # drops the kept G-buffers, needed after changing objects other than by transforms
+    gbuffers.clear()
+
+def set_light(position, index = 0):
+    # moves one of the lights
+    lights[index].position = vec3(*position)
+
+class RayLog:
+    # The secondary rays of a frame, reflected and shadow rays, as segments
+    # O + t * D with 0 <= t <= length, together with their pixels
+    def __init__(self):
+        self.batches = []
+
+    def add(self, O, D, length, pix):
+        self.batches.append((np.broadcast_to(O.v, D.v.shape), D.v, length, pix))
+
+    def segments(self):
+        # all segments as the arrays (O, D, length, pix)
+        if not self.batches:
+            return (np.empty((0, 3), dtype=DTYPE), np.empty((0, 3), dtype=DTYPE), np.empty(0, dtype=DTYPE),
+                    np.empty(0, dtype=int))
+        return tuple(np.concatenate(parts) for parts in zip(*self.batches))
+
+class IncrementalFrame:
+    # The last frame of trace_incremental: its colors, a fingerprint (see
+    # content_hash) and the bounds of every object when it was traced, and
+    # its secondary rays
+    def __init__(self, key, color):
+        self.key = key
+        self.color = color                      # (height * width, 3) colors
+        self.states = None
+        self.bounds = None
+        self.segments = None
+
+    def keep(self, objects, states):
+        self.states = states
+        self.bounds = [object.bounds() for object in objects]
+
+raylog = None               # the RayLog recorded while trace_incremental traces
+incremental_frames = {}     # (width, height) -> IncrementalFrame of the last frame
+INCREMENTAL_FRAMES_CACHED = 4   # max. number of kept frames, one per preview scale
+
+def incremental_key(width, height):
+    # everything that changes every pixel, the objects are compared one by one
+    return (width, height, tuple(map(id, scene)), camera.tobytes(), E.v.tobytes(), pickle.dumps(lights),
+            DTYPE, integrator.max_depth, integrator.threshold, integrator.roulette)
+
+def pixel_rays(width, height, pix):
+    # the primary ray directions of the pixels with the flat indices pix
+    if width * height <= PRIMARY_RAYS_MAX:
+        return primary_rays(width, height).take(pix)
+    S = screen(width, height)
+    return rays_through(np.linspace(S[0], S[2], width)[pix % width], np.linspace(S[1], S[3], height)[pix // width])
+
+def screen_rect(width, height, lo, hi):
+    # the pixels x0 <= x < x1, y0 <= y < y1 whose camera rays can hit the box lo, hi,
+    # the bounds of its corners projected onto the screen
+    corners = np.array([(x, y, z) for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+    world_to_camera = np.linalg.inv(camera)
+    P = transform_points(world_to_camera, corners)
+    e = transform_points(world_to_camera, E.array())
+    if (P[:, 2] <= e[2]).any():
+        return (0, 0, width, height)            # the box reaches behind the eye
+    t = -e[2] / (P[:, 2] - e[2])                # the corners projected onto the screen at z = 0
+    S = screen(width, height)
+    px = (e[0] + t * (P[:, 0] - e[0]) - S[0]) * ((width - 1) / (S[2] - S[0]))
+    py = (e[1] + t * (P[:, 1] - e[1]) - S[1]) * ((height - 1) / (S[3] - S[1]))
+    return (max(int(np.floor(px.min())), 0), max(int(np.floor(py.min())), 0),
+            min(int(np.ceil(px.max())) + 1, width), min(int(np.ceil(py.max())) + 1, height))
+
+def dirty_pixels(width, height, boxes, segments):
+    # True for the pixels that can see one of the boxes (lo, hi), through
+    # their camera ray or one of the secondary rays in segments
+    dirty = np.zeros((height, width), dtype=bool)
+    if any(box is None for box in boxes):
+        dirty[...] = True                       # an unbounded object changed
+        return dirty
+    (O, D, length, pix) = segments
+    with np.errstate(divide='ignore'):
+        invD = as_vec3(1 / D)
+    for (lo, hi) in boxes:
+        (x0, y0, x1, y1) = screen_rect(width, height, lo, hi)
+        dirty[y0:y1, x0:x1] = True
+        dirty.flat[pix[BVH.hits_box(BVHNode(lo, hi), as_vec3(O), invD, length)]] = True
+    return dirty
+
+def trace_incremental(width, height, out = None, budget = MEMORY_BUDGET):
+    # Dirty rectangle rendering. Traces the first frame in full and keeps it,
+    # see IncrementalFrame. When the next frame differs from it only in some
+    # objects, it traces just the pixels inside the screen rectangles of
+    # their old and new bounds and those with a reflected or shadow ray
+    # through these bounds, and keeps the colors of all other pixels.
+    global raylog
+    n = width * height
+    key = incremental_key(width, height)
+    states = [content_hash(object) for object in scene]
+    frame = incremental_frames.pop((width, height), None)
+    if frame is None or frame.key != key:
+        frame = IncrementalFrame(key, as_vec3(np.zeros((n, 3), dtype=DTYPE)))
+        dirty = np.ones((height, width), dtype=bool)
+    else:
+        changed = [i for (i, state) in enumerate(states) if state != frame.states[i]]
+        boxes = [frame.bounds[i] for i in changed] + [scene[i].bounds() for i in changed]
+        dirty = dirty_pixels(width, height, boxes, frame.segments)
+    pix = np.flatnonzero(dirty)
+
+    world = timed("bvh", BVH, scene)
+    set_pixel_spread(width, height)
+    frame.color.v[pix] = 0
+    raylog = RayLog()
+    try:
+        step = max(1, budget // RAY_BYTES)
+        for start in range(0, len(pix), step):
+            D = timed("rays", pixel_rays, width, height, pix[start:start + step])
+            raytrace(E, D, world, frame.color, pix[start:start + step])
+    finally:
+        (log, raylog) = (raylog, None)
+
+    # the secondary rays of the clean pixels stay, those of the traced ones are replaced
+    segments = log.segments()
+    if frame.segments is not None:
+        clean = ~dirty.flat[frame.segments[3]]
+        segments = tuple(np.concatenate((old[clean], new)) for (old, new) in zip(frame.segments, segments))
+    frame.segments = segments
+    frame.keep(scene, states)
+    if len(incremental_frames) >= INCREMENTAL_FRAMES_CACHED:
+        incremental_frames.pop(next(iter(incremental_frames)))
+    incremental_frames[(width, height)] = frame
+
+    if out is None:
+        out = np.empty((height, width, 3), dtype=DTYPE)
+    store(out, frame.color.v.reshape((height, width, 3)))
+    return out
+
+def timed(stage, f, *args):
+    # f(*args), its time added to the frame stage while stats are enabled
+    if stats is None:
+        return f(*args)
+    t0 = time.perf_counter()
+    result = f(*args)
+    stats.add(stage, None, time.perf_counter() - t0)
+    return result
+
+def trace_frame(width, height, workers = 0, aa = False, out = None, budget = MEMORY_BUDGET, deferred = False,
+                incremental = False):
+    # traces the current scene into out, by default new (height, width, 3) float colors,
+    # workers > 1 traces the frame in tiles on a process pool, aa anti-aliases edges,
+    # deferred keeps a G-buffer so that moving the light only shades again,
+    # incremental traces only the pixels that objects changed since the last
+    # frame (deferred and incremental not together with workers or aa, which
+    # trace every frame, incremental takes precedence)
+    if stats is not None:
+        enable_stats()                  # counts this frame only
+        t0 = time.perf_counter()
+    apply_transform()
+    if workers > 1:
+        out = tile_renderer(workers).render(width, height, aa, out)
+    elif incremental and not aa:
+        out = trace_incremental(width, height, out, budget)
+    elif deferred and not aa:
+        out = trace_deferred(width, height, out, budget)
+    else:
+        out = trace_chunked(width, height, timed("bvh", BVH, scene), out, budget, aa)
+    if stats is not None:
+        stats.add("frame", None, time.perf_counter() - t0, width * height)
+    return out
+
+def to_rgb8(color, out = None):
+    # 8 bit colors, written into the uint8 image out if given
+    def convert():
+        rgb8 = np.clip(color, 0, 1)
+        rgb8 *= 255
+        if out is None:
+            return rgb8.astype(np.uint8)
+        np.copyto(out, rgb8, casting='unsafe')
+        return out
+    return timed("convert", convert)
+
+def store(out, color):
+    # writes float colors into out, a float or uint8 image or a view of one
+    if out.dtype == np.uint8:
+        to_rgb8(color, out)
+    else:
+        out[...] = color
+
+FRAME_KEY_RESOLUTION = 1000    # quantum of the floats in frame_key, in units of the dtype resolution
+
+def content_hash(value, quantum = None):
+    # blake2b hash of value, nested lists, tuples, dicts, arrays and objects
+    # included, with the floats rounded to multiples of quantum if given.
+    # Textures enter with their digest, objects with the state pickle keeps,
+    # which leaves out derived data such as the BVH of a mesh.
+    h = hashlib.blake2b(digest_size=16)
+    def feed(value):
+        if isinstance(value, vec3):
+            value = value.v
+        if quantum is not None and (isinstance(value, float) or isinstance(value, np.ndarray) and value.dtype.kind == 'f'):
+            value = np.round(np.asarray(value, dtype=float) / quantum).astype(np.int64)
+        if isinstance(value, np.ndarray):
+            h.update(repr(value.shape).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (list, tuple)):
+            h.update(b"[%d" % len(value))
+            for item in value:
+                feed(item)
+        elif isinstance(value, dict):
+            for name in sorted(value):
+                h.update(name.encode())
+                feed(value[name])
+        elif isinstance(value, Texture):
+            h.update(value.digest)
+        elif hasattr(value, "__dict__"):
+            h.update(type(value).__name__.encode())
+            feed(value.__getstate__() if hasattr(value, "__getstate__") else vars(value))
+        else:
+            h.update(repr(value).encode())
+    feed(value)
+    return h.hexdigest()
+
+def frame_key(width, height, aa = False):
+    # content hash of everything the image depends on: resolution, camera,
+    # lights, integrator and the parameters of all primitives. The floats are
+    # rounded to a multiple of a quantum first, so that transforms that
+    # cancel out (rotating forth and back) give the same key again.
+    quantum = FRAME_KEY_RESOLUTION * np.finfo(DTYPE).resolution
+    return content_hash([width, height, aa, np.dtype(DTYPE).name, camera, E, integrator.__getstate__(), lights, scene],
+                        quantum)
+
+FRAME_CACHE_BYTES = 64 << 20    # default memory bound of the frame cache
+
+class FrameCache:
+    # Least recently used cache of finished 8 bit frames by frame_key, at
+    # most max_bytes of them in memory. With a directory the frames are also
+    # stored there as .npy files, which outlive the process, and the least
+    # recently used files are deleted beyond max_disk_bytes.
+    def __init__(self, max_bytes = FRAME_CACHE_BYTES, directory = None, max_disk_bytes = 4 * FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        # the read-only frame stored for key, or None
+        image = self.frames.get(key)
+        if image is not None:
+            self.frames.move_to_end(key)
+        elif self.directory is not None:
+            image = self.load(key)
+        if image is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return image
+
+    def put(self, key, image):
+        image = np.array(image)
+        image.setflags(write=False)
+        self.remember(key, image)
+        if self.directory is not None:
+            self.store(key, image)
+
+    def remember(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        if key in self.frames:
+            self.bytes -= self.frames.pop(key).nbytes
+        self.frames[key] = image
+        self.bytes += image.nbytes
+        while self.bytes > self.max_bytes:
+            self.bytes -= self.frames.popitem(last=False)[1].nbytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def load(self, key):
+        try:
+            image = np.load(self.path(key))
+        except (OSError, ValueError):           # not stored, or a damaged file
+            return None
+        os.utime(self.path(key))                # marks it as recently used
+        image.setflags(write=False)
+        self.remember(key, image)
+        return image
+
+    def store(self, key, image):
+        # written under a temporary name first, so that no reader sees half a file
+        with open(self.path(key) + ".tmp", "wb") as file:
+            np.save(file, image)
+        os.replace(self.path(key) + ".tmp", self.path(key))
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".npy")]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in files)
+        for entry in files[:-1]:
+            if size <= self.max_disk_bytes:
+                break
+            size -= entry.stat().st_size
+            os.remove(entry.path)
+
+frame_cache = None          # a FrameCache while enabled, see render_scene
+
+def enable_frame_cache(on = True, max_bytes = FRAME_CACHE_BYTES, directory = None):
+    global frame_cache
+    frame_cache = FrameCache(max_bytes, directory) if on else None
+
+def render_scene(width, height, pos = False, neg = False, workers = 0, aa = False, deferred = False, out = None,
+                 incremental = False):
+    # returns the 8 bit image, traced straight into out if given: a (height, width, 3)
+    # uint8 image or a view of one, e.g. image[::-1] for the bottom up rows of OpenGL
+    # with the frame cache enabled, scene states seen before are not traced again
+    # (the returned image is then read-only unless out is given)
+    rotate_scene(pos, neg)
 
     t0 = time.time()
-    Q = vec3(x, y, 0)
-    color = raytrace(E, (Q - E).norm(), scene)
+    if frame_cache is not None:
+        apply_transform()
+        key = frame_key(width, height, aa)
+        image = frame_cache.get(key)
+        if image is not None:
+            print ("Took", time.time() - t0, "(cached)")
+            if out is None:
+                return image
+            out[...] = image
+            return out
+    color = trace_frame(width, height, workers, aa, out, deferred=deferred, incremental=incremental)
     print ("Took", time.time() - t0)
 
-    rgb = [Image.fromarray((255 * np.clip(c, 0, 1).reshape((height, width))).astype(np.uint8), "L") for c in color.components()]
-    im = Image.merge("RGB", rgb)
-    return np.array(im)
+    image = color if out is not None else to_rgb8(color)
+    if frame_cache is not None:
+        frame_cache.put(key, image)
+    return image
+
+TILE_SIZE = 64              # edge length of the tiles traced by one task
+
+def tiles(width, height, size = TILE_SIZE):
+    return [(x0, y0, min(x0 + size, width), min(y0 + size, height))
+            for y0 in range(0, height, size) for x0 in range(0, width, size)]
+
+worker_state = {}           # scene version, BVH and framebuffer of a pool process
+SHARED_GLOBALS = ("E", "lights", "camera", "integrator", "DTYPE")    # sent to the pool with the scene
+
+def trace_tile_task(task):
+    # runs in a pool process: loads the scene, camera and integrator once per version,
+    # traces one tile and writes it into the shared framebuffer
+    (scene_name, scene_size, version, fb_name, width, height, tile, aa) = task
+    if worker_state.get("version") != version:
+        shm = shared_memory.SharedMemory(scene_name)
+        (objects, state) = pickle.loads(shm.buf[:scene_size])
+        shm.close()
+        globals().update(state)
+        worker_state.update(version=version, world=BVH(objects))
+    if worker_state.get("fb_name") != fb_name:
+        if "fb" in worker_state:
+            worker_state["fb"].close()
+        worker_state.update(fb_name=fb_name, fb=shared_memory.SharedMemory(fb_name))
+    fb = np.ndarray((height, width, 3), dtype=float, buffer=worker_state["fb"].buf)
+    (x0, y0, x1, y1) = tile
+    fb[y0:y1, x0:x1] = trace_tile(width, height, tile, worker_state["world"], aa)
+
+class TileRenderer:
+    # Process pool that traces the frame in tiles. The pickled scene is put
+    # into shared memory once per change and loaded once by every worker,
+    # the tiles are written straight into a shared memory framebuffer.
+    def __init__(self, workers = os.cpu_count(), tile_size = TILE_SIZE):
+        self.workers = workers
+        self.tile_size = tile_size
+        # start the resource tracker first, so that the pool processes share
+        # it and do not unlink the shared memory blocks when they exit
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(workers)
+        self.version = 0
+        self.scene_data = None
+        self.scene_shm = None
+        self.fb_shm = None
+        self.fb = None
+
+    def upload_scene(self):
+        data = pickle.dumps((scene, {name: globals()[name] for name in SHARED_GLOBALS}))
+        if data == self.scene_data:
+            return
+        if self.scene_shm is not None:
+            self.scene_shm.close()
+            self.scene_shm.unlink()
+        self.scene_shm = shared_memory.SharedMemory(create=True, size=len(data))
+        self.scene_shm.buf[:len(data)] = data
+        self.scene_data = data
+        self.version += 1
+
+    def framebuffer(self, width, height):
+        if self.fb is None or self.fb.shape != (height, width, 3):
+            self.fb = None
+            if self.fb_shm is not None:
+                self.fb_shm.close()
+                self.fb_shm.unlink()
+            self.fb_shm = shared_memory.SharedMemory(create=True, size=height * width * 3 * 8)
+            self.fb = np.ndarray((height, width, 3), dtype=float, buffer=self.fb_shm.buf)
+        return self.fb
+
+    def render(self, width, height, aa = False, out = None):
+        # the frame as new float colors, or written into out (see store)
+        self.upload_scene()
+        fb = self.framebuffer(width, height)
+        tasks = [(self.scene_shm.name, len(self.scene_data), self.version, self.fb_shm.name, width, height, tile, aa)
+                 for tile in tiles(width, height, self.tile_size)]
+        self.pool.map(trace_tile_task, tasks, chunksize=1)
+        if out is None:
+            return fb.copy()
+        store(out, fb)
+        return out
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.fb = None
+        for shm in (self.scene_shm, self.fb_shm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.scene_shm = self.fb_shm = None
+
+tile_renderers = {}
+
+def tile_renderer(workers):
+    # one persistent pool per worker count
+    if workers not in tile_renderers:
+        tile_renderers[workers] = TileRenderer(workers)
+    return tile_renderers[workers]
+
+@atexit.register
+def close_tile_renderers():
+    for renderer in tile_renderers.values():
+        renderer.close()
+    tile_renderers.clear()
+
+def scaling_report(width, height, worker_counts, repeat = 3):
+    # best-of-repeat wall time per worker count, speedup and parallel
+    # efficiency (speedup / workers) relative to the single process path
+    def best(trace):
+        trace()                         # warm up pool and caches
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            trace()
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    serial = best(lambda: trace_tile(width, height, (0, 0, width, height), BVH(scene)))
+    report = [{"workers": 1, "seconds": serial, "speedup": 1.0, "efficiency": 1.0}]
+    for workers in worker_counts:
+        if workers <= 1:
+            continue
+        renderer = tile_renderer(workers)
+        seconds = best(lambda: renderer.render(width, height))
+        report.append({"workers": workers, "seconds": seconds,
+                       "speedup": serial / seconds, "efficiency": serial / seconds / workers})
+    return report
+
+if __name__ == "__main__":
+    counts = [1, 2, 4, 8, 16, 32]
+    counts = [n for n in counts if n <= os.cpu_count()] or [1]
+    print("workers  seconds  speedup  efficiency")
+    for row in scaling_report(640, 480, counts):
+        print("%7d  %7.3f  %7.2f  %10.2f" % (row["workers"], row["seconds"], row["speedup"], row["efficiency"]))
@@ -24,32 +24,69 @@
  ****
 """
 
+from collections import deque
+from functools import partial
+
 from rendering import Scene, RenderWindow
 import raytracer as rt
 
 class RayTracer:
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, orbit = False, workers = 0, incremental = False, cache = True):
         self.width  = width
         self.height = height
-
-        # TODO: setup your ray tracer
+        self.orbit  = orbit     # rotate the camera around the scene instead of the scene
+        self.workers = workers  # trace on a process pool of this many workers
+        self.incremental = incremental  # trace only the pixels changed objects cover, see rt.trace_incremental
+        rt.enable_frame_cache(cache)    # serve scene states seen before from memory, see rt.FrameCache
+        # Scene changes are queued and applied by render(), so that they never
+        # happen in the middle of a trace when the scene renders in the background
+        self.commands = deque()
+        self.stats_lines = []
+        self.light_position = tuple(rt.lights[0].position.array())
 
     def resize(self, new_width, new_height):
-        self.width  = new_width
-        self.height = new_height
-        # TODO: modify scene accordingly
+        # the primary rays are cached per resolution, nothing to clear
+        self.commands.append(partial(self.set_size, new_width, new_height))
+
+    def set_size(self, width, height):
+        self.width  = width
+        self.height = height
 
     def rotate_pos(self):
-        # TODO: modify scene accordingly
-        rt.render_scene(self.width, self.height, pos=True)
+        self.commands.append(partial(rt.orbit_camera if self.orbit else rt.rotate_scene, pos=True))
 
     def rotate_neg(self):
-        # TODO: modify scene accordingly
-        rt.render_scene(self.width, self.height, neg=True)
+        self.commands.append(partial(rt.orbit_camera if self.orbit else rt.rotate_scene, neg=True))
+
+    def light(self):
+        return self.light_position
+
+    def move_light(self, position):
+        # the image is shaded again from the G-buffer, without tracing, see rt.trace_deferred
+        self.light_position = tuple(position)
+        self.commands.append(partial(rt.set_light, position))
+
+    def enable_stats(self, on):
+        self.commands.append(partial(rt.enable_stats, on))
+
+    def stats(self):
+        # per stage timings of the last traced image, empty while disabled
+        return self.stats_lines
 
-    def render(self):
-        return rt.render_scene(self.width, self.height)
+    def render(self, scale = 1, out = None):
+        # scale > 1 renders a preview with about 1 / scale of the resolution,
+        # out is a (height, width, 3) uint8 image (or view) to render into instead
+        while self.commands:
+            self.commands.popleft()()
+        if out is not None:
+            (height, width) = out.shape[:2]
+        else:
+            (width, height) = (-(-self.width // scale), -(-self.height // scale))
+        image = rt.render_scene(width, height, workers=self.workers, deferred=True, out=out,
+                                incremental=self.incremental)
+        self.stats_lines = rt.stats.lines() if rt.stats is not None else []
+        return image
 
 # main function
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+"""
+Headless renderer for raytracer.py
+
+Renders the scene at a given resolution and rotation state straight to a
+PNG, or to a .npy file holding the raw (height, width, 3) float colors,
+without a window or OpenGL context. PIL is only imported to write PNGs.
+Large frames are traced in chunks that fit into --budget.
+
+    python render_headless.py out.png --size 640x480 --steps 3
+    python render_headless.py out.npy --angle 45 --orbit --float32
+"""
+
+import argparse
+import json
+import sys
+import time
+
+
+def size(text):
+    (width, height) = text.lower().split("x")
+    return (int(width), int(height))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output", help="a .png or .npy file")
+    parser.add_argument("--size", type=size, default=(640, 480), help="WIDTHxHEIGHT")
+    parser.add_argument("--steps", type=int, default=0, help="rotation steps of pi/10, negative for the other way")
+    parser.add_argument("--angle", type=float, help="rotation angle in degrees, instead of --steps")
+    parser.add_argument("--orbit", action="store_true", help="move the camera instead of the scene")
+    parser.add_argument("--workers", type=int, default=0, help="trace on a pool of this many processes")
+    parser.add_argument("--depth", type=int, default=2, help="reflection bounces")
+    parser.add_argument("--aa", action="store_true", help="anti-alias the edges")
+    parser.add_argument("--float32", action="store_true", help="trace in single precision")
+    parser.add_argument("--budget", type=int, default=256, help="memory budget of the tracing in MiB")
+    parser.add_argument("--time", action="store_true", help="print the trace time to stderr")
+    parser.add_argument("--stats", action="store_true", help="print per stage timings and counts as JSON to stderr")
+    args = parser.parse_args(argv)
+    if not args.output.endswith((".png", ".npy")):
+        parser.error("output must be a .png or .npy file")
+
+    import numpy as np
+    import raytracer as rt
+
+    if args.stats:
+        rt.enable_stats()
+    if args.float32:
+        rt.set_precision(np.float32)
+    rt.integrator = rt.Integrator(max_depth=args.depth)
+    angle = np.radians(args.angle) if args.angle is not None else args.steps * rt.ROTATION_STEP
+    if angle:
+        if args.orbit:
+            rt.orbit(rt.rotation(angle))
+        else:
+            rt.push_transform(rt.rotation(angle))
+
+    png = args.output.endswith(".png")
+    (width, height) = args.size
+    out = np.empty((height, width, 3), dtype=np.uint8) if png else None
+    t0 = time.perf_counter()
+    image = rt.trace_frame(width, height, args.workers, args.aa, out, args.budget << 20)
+    if args.time:
+        print("Took", time.perf_counter() - t0, file=sys.stderr)
+    if args.stats:
+        print(json.dumps(rt.stats.report(), indent=2), file=sys.stderr)
+
+    if png:
+        from PIL import Image
+        Image.fromarray(image).save(args.output)
+    else:
+        np.save(args.output, image)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
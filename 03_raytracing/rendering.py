@@ -31,6 +31,8 @@ import imgui
 import numpy as np
 import moderngl as mgl
 import os
+import threading
+import traceback
 
 from imgui.integrations.glfw import GlfwRenderer
 
@@ -54,6 +56,28 @@ class Scene:
         self.ray_tracer         = ray_tracer
         self.gl_texture         = None
 
+        # Progressive rendering: a new image is first traced at 1/preview_scale
+        # of the resolution, every following frame halves scale until the
+        # full resolution is reached
+        self.progressive        = True
+        self.preview_scale      = 8
+        self.scale              = 1
+
+        # Statistics window with per stage timings, see draw_ui()
+        self.show_stats         = False
+
+        # Background rendering: a worker thread traces the images and hands
+        # them over through two buffers (front, back) in GL row order, render()
+        # uploads the newest front buffer without ever waiting for the tracer
+        self.background         = True
+        self.frames             = None
+        self.fresh              = False             # front buffer not uploaded yet
+        self.swap               = threading.Lock()  # guards frames and fresh
+        self.requests           = threading.Condition()
+        self.requested          = 0                 # number of requested images
+        self.worker             = None
+        self.pbo                = None
+
         # Rendering
         self.ctx                = None              # Assigned when calling init_gl()
         self.point_size         = 1
@@ -103,6 +127,9 @@ class Scene:
 
         # Initialize a moderngl_texture object that can be written and store the ray traced results
         self.initialize_gl_texture()
+        if self.background:
+            self.worker = threading.Thread(target=self.render_loop, daemon=True)
+            self.worker.start()
         self.update_ray_tracer_image()
 
         # Set projection matrix
@@ -145,6 +172,10 @@ class Scene:
         gl_texture.repeat_y = False
         self.gl_texture     = gl_texture
 
+        # New front and back buffers, images traced for the old size are dropped
+        with self.swap:
+            self.frames     = [np.zeros_like(image_data), np.zeros_like(image_data)]
+            self.fresh      = False
 
 
     def resize(self, width, height):
@@ -162,18 +193,138 @@ class Scene:
 
     def update_ray_tracer_image(self):
 
+        # Ask the worker thread for a new image, it supersedes any image in progress
+        if self.background:
+            with self.requests:
+                self.requested += 1
+                self.requests.notify()
+            return
+
+        # Start with a coarse preview, render() refines it in later frames
+        self.scale = self.preview_scale if self.progressive else 1
+        self.trace_image()
+
+
+    def trace_image(self):
+
         # Get Image fram Ray Tracer and write it to the GPU
-        image = self.ray_tracer.render()
+        image = self.frames[0]
+        if self.trace_into(image, self.scale):
+            self.upload(image)
+
+
+    def trace_into(self, image, scale):
+
+        # Full resolution images are traced straight into image, in GL row
+        # order (bottom row first), previews are upscaled into it
+        if scale == 1:
+            self.ray_tracer.render(out=image[::-1])
+            return True
+        preview = self.gl_image(self.ray_tracer.render(scale), scale)
+        if preview.shape != image.shape:
+            return False
+        image[...] = preview
+        return True
+
+
+    def gl_image(self, image, scale):
+
+        # Upscale previews to the texture size (nearest neighbour)
+        if scale > 1:
+            image = np.repeat(np.repeat(image, scale, 0), scale, 1)[:self.height, :self.width]
 
         # Flip y-axis (OpenGL y-Axis starts at Bottom)
-        image = np.flip(image, 0)
+        return np.flip(image, 0)
+
+
+    def render_loop(self):
+
+        # Worker thread: traces the newest request coarse to fine (with
+        # progressive rendering) and stops refining once a newer one arrives
+        done = 0
+        while True:
+            with self.requests:
+                self.requests.wait_for(lambda: self.requested != done)
+                done = self.requested
+            scale = self.preview_scale if self.progressive else 1
+            while scale >= 1 and done == self.requested:
+                try:
+                    self.publish(scale)
+                except Exception:
+                    # keep the thread alive, the next request traces again
+                    traceback.print_exc()
+                    break
+                scale //= 2
+
+
+    def publish(self, scale):
+
+        # Worker thread: fills the back buffer, which only this thread writes,
+        # and swaps it to the front
+        back = self.frames[1]
+        if not self.trace_into(back, scale):
+            return
+        with self.swap:
+            if self.frames[1] is back:
+                self.frames = [back, self.frames[0]]
+                self.fresh  = True
+
+
+    def upload(self, image):
+
+        # Stream the image through an orphaned pixel buffer, the driver then
+        # copies it into the texture without stalling on the previous upload
+        if self.pbo is None or self.pbo.size != image.nbytes:
+            if self.pbo is not None:
+                self.pbo.release()
+            self.pbo = self.ctx.buffer(reserve=image.nbytes, dynamic=True)
+        else:
+            self.pbo.orphan()
+        self.pbo.write(image)
 
         # Re-Write and Re-Bind texture
-        self.gl_texture.write(np.ascontiguousarray(image))
+        self.gl_texture.write(self.pbo)
+
+
+    def draw_ui(self):
+
+        # Statistics of the last traced image, if the ray tracer records them
+        if hasattr(self.ray_tracer, "enable_stats"):
+            imgui.begin("Statistics")
+            changed, self.show_stats = imgui.checkbox("Record", self.show_stats)
+            if changed:
+                self.ray_tracer.enable_stats(self.show_stats)
+                self.update_ray_tracer_image()
+            for line in self.ray_tracer.stats():
+                imgui.text(line)
+            imgui.end()
+
+        # Light position, if the ray tracer can move the light
+        if hasattr(self.ray_tracer, "move_light"):
+            imgui.begin("Light")
+            changed, position = imgui.slider_float3("Position", *self.ray_tracer.light(), -10, 10)
+            if changed:
+                self.ray_tracer.move_light(position)
+                self.update_ray_tracer_image()
+            imgui.end()
 
 
     def render(self):
 
+        # Upload the newest finished image, unless the worker is just swapping
+        if self.background:
+            if self.fresh and self.swap.acquire(blocking=False):
+                try:
+                    self.upload(self.frames[0])
+                    self.fresh = False
+                finally:
+                    self.swap.release()
+
+        # Refine a progressive image by one level per frame
+        elif self.scale > 1:
+            self.scale //= 2
+            self.trace_image()
+
         # Fill Background
         self.ctx.clear(*self.bg_color)
 
@@ -301,6 +452,7 @@ class RenderWindow:
                     self.scene.update_ray_tracer_image()
 
                 imgui.end()                         # End window context
+                self.scene.draw_ui()                # Scene specific windows
                 imgui.render()                      # Run render callback
                 imgui.end_frame()                   # End frame context
                 self.impl.process_inputs()          # Poll for UI events
@@ -0,0 +1,130 @@
+"""
+Turntable batch renderer for raytracer.py
+
+Renders the scene at every rotation state of a turntable (N evenly spaced
+angles, by default the 20 steps of pi/10, or an explicit angle list) on a
+process pool. Every worker transforms its own copy of the scene, and the
+finished frames are written by a background thread while tracing goes on.
+
+    python turntable.py "frames/frame_%03d.png" --size 320x240
+    python turntable.py "frames/frame_%03d.npy" --angles 0 10 20 --orbit
+"""
+
+import argparse
+import os
+import pickle
+import queue
+import sys
+import threading
+import multiprocessing
+
+import numpy as np
+import raytracer as rt
+
+base_state = None           # pickled scene and shared globals, set in every worker
+
+
+def init_worker(state):
+    global base_state
+    base_state = state
+
+
+def render_frame(task):
+    # runs in a pool process: traces one turntable frame from a fresh copy of the scene
+    (index, angle, width, height, orbit, aa, raw) = task
+    (objects, state) = pickle.loads(base_state)
+    vars(rt).update(state)
+    rt.scene = objects
+    rt.pending_transform = np.eye(4)
+    if orbit:
+        rt.orbit(rt.rotation(angle))
+    else:
+        rt.push_transform(rt.rotation(angle))
+    color = rt.trace_frame(width, height, aa=aa)
+    return (index, color if raw else rt.to_rgb8(color))
+
+
+def write_frames(frames, pattern, errors):
+    # writer thread: saves (index, image) pairs until it gets None. After the
+    # first error, kept in errors, it only drains the queue, so that the
+    # renderer never blocks on a full queue
+    while True:
+        frame = frames.get()
+        if frame is None:
+            return
+        if errors:
+            continue
+        (index, image) = frame
+        try:
+            path = pattern % index
+            if path.endswith(".npy"):
+                np.save(path, image)
+            else:
+                from PIL import Image
+                Image.fromarray(image).save(path)
+        except Exception as error:
+            errors.append(error)
+
+
+def render_turntable(pattern, width, height, angles, orbit = False, aa = False, workers = os.cpu_count()):
+    # renders one frame per angle (radians, relative to the current scene)
+    # to pattern % index, a .png or .npy path
+    rt.apply_transform()
+    state = pickle.dumps((rt.scene, {name: vars(rt)[name] for name in rt.SHARED_GLOBALS}))
+    raw = pattern.endswith(".npy")
+    tasks = [(index, angle, width, height, orbit, aa, raw) for (index, angle) in enumerate(angles)]
+
+    frames = queue.Queue(maxsize=2 * workers)
+    errors = []
+    writer = threading.Thread(target=write_frames, args=(frames, pattern, errors))
+    writer.start()
+    try:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(state,)) as pool:
+            for frame in pool.imap_unordered(render_frame, tasks):
+                if errors:
+                    break                       # leaving the pool terminates the remaining tasks
+                frames.put(frame)
+    finally:
+        frames.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return [pattern % index for index in range(len(angles))]
+
+
+def size(text):
+    (width, height) = text.lower().split("x")
+    return (int(width), int(height))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pattern", help="output path with a %%d for the frame index, .png or .npy")
+    parser.add_argument("--size", type=size, default=(640, 480), help="WIDTHxHEIGHT")
+    parser.add_argument("--frames", type=int, default=int(round(2 * np.pi / rt.ROTATION_STEP)),
+                        help="number of evenly spaced rotation states")
+    parser.add_argument("--angles", type=float, nargs="+", help="rotation angles in degrees, instead of --frames")
+    parser.add_argument("--orbit", action="store_true", help="move the camera instead of the scene")
+    parser.add_argument("--aa", action="store_true", help="anti-alias the edges")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+    if not args.pattern.endswith((".png", ".npy")):
+        parser.error("pattern must end in .png or .npy")
+    try:
+        args.pattern % 0
+    except (TypeError, ValueError):
+        parser.error("pattern must contain one %d for the frame index")
+
+    if args.angles is not None:
+        angles = np.radians(args.angles)
+    else:
+        angles = np.arange(args.frames) * (2 * np.pi / args.frames)
+    directory = os.path.dirname(args.pattern)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    render_turntable(args.pattern, *args.size, angles, args.orbit, args.aa, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())